@@ -9,15 +9,37 @@
 # -----------------------------------------------------------
 
 import os
-from qgis.PyQt.QtCore import pyqtSlot, QCoreApplication, QTranslator, QObject, QLocale, QSettings
-from qgis.PyQt.QtWidgets import QAction, QMenu
-from qgis.core import QgsProject, QgsRelation, QgsFeature, QgsEditorWidgetSetup, QgsGeometry, QgsMapLayer, Qgis, QgsVectorLayer, QgsMapLayerType
+from collections import namedtuple
+from qgis.PyQt.QtCore import pyqtSlot, QCoreApplication, QTranslator, QObject, QLocale, QSettings, Qt, QTimer
+from qgis.PyQt.QtWidgets import QAction, QApplication, QMenu, QProgressDialog, QPushButton
+from qgis.core import QgsProject, QgsRelation, QgsFeature, QgsEditorWidgetSetup, QgsGeometry, QgsMapLayer, Qgis, QgsVectorLayer, QgsApplication, QgsFeedback, QgsMessageLog
 from qgis.gui import QgsGui, QgisInterface, QgsMapLayerAction
 from actions_for_relations.core.settings import Settings
-from actions_for_relations.core.custom_aggregate import CustomAggregate
+from actions_for_relations.core.aggregate_engine import EXTREMUM_AGGREGATES
+from actions_for_relations.core.custom_aggregate import CustomAggregate, read_custom_aggregates
+from actions_for_relations.core.relation_index import relation_index
+from actions_for_relations.core.selection import selection_behavior
+from actions_for_relations.core.batch_insert import create_referencing_features
+from actions_for_relations.core.child_index import ChildIndexCache
+from actions_for_relations.core.filters import fid_filter_expression
+from actions_for_relations.core.instrumentation import Instrumentation, LOG_TAG
+from actions_for_relations.core.tasks import (
+    ReferencedKeysTask, RelationsKeysTask, ReferencingFeaturesTask, AggregateTask, ChildIndexTask, DescendantsTask,
+    ReferencedFeaturesTask, ExportTask, IntegrityTask
+)
 from actions_for_relations.gui.aggregates_dialog import AggregatesDialog
+from actions_for_relations.gui.export_dialog import ExportDialog
+from actions_for_relations.gui.results_dock import ResultsDock
 
-DEBUG = True
+
+# delay in milliseconds to coalesce the changes of relations and layers
+RELOAD_DELAY = 100
+
+# everything the actions of a relation are built from
+RelationSignature = namedtuple('RelationSignature', [
+    'relation_id', 'relation_name', 'referenced_layer_id', 'referenced_layer_name',
+    'referencing_layer_id', 'referencing_layer_name', 'field_pairs', 'custom_aggregates'
+])
 
 
 class ActionsForRelationsPlugin(QObject):
@@ -28,16 +50,39 @@ class ActionsForRelationsPlugin(QObject):
         QObject.__init__(self)
         self.iface = iface
         self.settings = Settings()
-        self.map_layer_actions = []
-        # context menu entries
-        self.layer_tree_actions = []
+        # relation id => (signature, [map layer actions])
+        self.map_layer_actions = {}
+        # context menu entries: layer id => (relation ids, menu action)
+        self.layer_tree_actions = {}
         self.menu_action = None
+        self.integrity_action = None
+        self.results_dock = None
+        # running tasks
+        self.tasks = []
+        self.child_indexes = ChildIndexCache(self.settings.value('child_index_memory_budget') * 2 ** 20)
         self.custom_aggregates = []
+        # relation id => [custom aggregates]
+        self.aggregates_by_relation = {}
+
+        # create the relation index first, so it is invalidated before the actions get reloaded
+        relation_index()
+
+        self.set_custom_aggregates(read_custom_aggregates(self.settings))
 
-        for definition in self.settings.value('custom_aggregates'):
-            self.custom_aggregates.append(CustomAggregate(definition))
+        # bursts of changes are coalesced in a single reload, postponed while the project is being read
+        self.project_loading = False
+        self.reload_timer = QTimer(self)
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(RELOAD_DELAY)
+        self.reload_timer.timeout.connect(self.load_relations)
 
-        QgsProject.instance().relationManager().changed.connect(self.load_relations)
+        QgsProject.instance().cleared.connect(self.reload_custom_aggregates)
+        QgsProject.instance().layerLoaded.connect(self.on_project_loading)
+        QgsProject.instance().readProject.connect(self.on_project_read)
+        self.iface.newProjectCreated.connect(self.on_project_read)
+        QgsProject.instance().relationManager().changed.connect(self.schedule_load_relations)
+        QgsProject.instance().layersAdded.connect(self.schedule_load_relations)
+        QgsProject.instance().layersWillBeRemoved.connect(self.unload_layers)
 
         self.load_relations()
 
@@ -52,152 +97,678 @@ class ActionsForRelationsPlugin(QObject):
         self.menu_action = QAction(self.tr('Set custom aggregate actions'), self.iface.mainWindow())
         self.menu_action.triggered.connect(self.set_aggregates)
         self.iface.addPluginToMenu(self.plugin_name, self.menu_action)
+        self.integrity_action = QAction(self.tr('Check referential integrity'), self.iface.mainWindow())
+        self.integrity_action.triggered.connect(self.check_integrity)
+        self.iface.addPluginToMenu(self.plugin_name, self.integrity_action)
 
     def unload(self):
+        self.reload_timer.stop()
+        QgsProject.instance().cleared.disconnect(self.reload_custom_aggregates)
+        QgsProject.instance().layerLoaded.disconnect(self.on_project_loading)
+        QgsProject.instance().readProject.disconnect(self.on_project_read)
+        self.iface.newProjectCreated.disconnect(self.on_project_read)
+        QgsProject.instance().relationManager().changed.disconnect(self.schedule_load_relations)
+        QgsProject.instance().layersAdded.disconnect(self.schedule_load_relations)
+        QgsProject.instance().layersWillBeRemoved.disconnect(self.unload_layers)
+        self.cancel_tasks()
         self.unload_relations()
+        self.child_indexes.clear()
+        if self.results_dock:
+            self.iface.removeDockWidget(self.results_dock)
+            self.results_dock.deleteLater()
+            self.results_dock = None
         if self.menu_action:
             self.iface.removePluginMenu(self.plugin_name, self.menu_action)
+        if self.integrity_action:
+            self.iface.removePluginMenu(self.plugin_name, self.integrity_action)
 
     def set_aggregates(self):
         dlg = AggregatesDialog(self.custom_aggregates)
         if dlg.exec_():
-            self.custom_aggregates = dlg.aggregate_model.custom_aggregates
+            self.set_custom_aggregates(dlg.aggregate_model.custom_aggregates)
             self.load_relations()
 
+    def set_custom_aggregates(self, custom_aggregates: [CustomAggregate]):
+        self.custom_aggregates = custom_aggregates
+        self.aggregates_by_relation = {}
+        for custom_aggregate in self.custom_aggregates:
+            self.aggregates_by_relation.setdefault(custom_aggregate.relation_id, []).append(custom_aggregate)
+
+    def reload_custom_aggregates(self):
+        """
+        Reloads the custom aggregates when the project changes, since some are saved in the project
+        """
+        self.set_custom_aggregates(read_custom_aggregates(self.settings))
+        self.schedule_load_relations()
+
+    def schedule_load_relations(self):
+        """
+        Reloads the relations once the current burst of changes is over, unless the project is being read
+        """
+        if not self.project_loading:
+            self.reload_timer.start()
+
+    def on_project_loading(self):
+        # layers are loaded while reading a project, relations are only reloaded once it is read
+        self.project_loading = True
+        self.reload_timer.stop()
+
+    def on_project_read(self):
+        self.project_loading = False
+        self.reload_custom_aggregates()
+
     def unload_relations(self):
-        for action in self.map_layer_actions:
-            # remove general actions
+        for relation_id in list(self.map_layer_actions.keys()):
+            self.remove_map_layer_actions(relation_id)
+        for layer_id in list(self.layer_tree_actions.keys()):
+            self.remove_layer_tree_action(layer_id)
+
+    def remove_map_layer_actions(self, relation_id: str):
+        _, actions = self.map_layer_actions.pop(relation_id)
+        for action in actions:
             QgsGui.instance().mapLayerActionRegistry().removeMapLayerAction(action)
-        self.map_layer_actions = []
-        # remove legend context menu entries
-        for action in self.layer_tree_actions:
-            self.iface.removeCustomActionForLayerType(action)
-        self.layer_tree_actions = []
+
+    def remove_layer_tree_action(self, layer_id: str):
+        _, action = self.layer_tree_actions.pop(layer_id)
+        self.iface.removeCustomActionForLayerType(action)
+        action.menu().deleteLater()
+
+    @pyqtSlot('QStringList')
+    def unload_layers(self, layer_ids: [str]):
+        """
+        Removes the actions of the layers which are about to be removed
+        """
+        for relation_id, (signature, _) in list(self.map_layer_actions.items()):
+            if signature.referenced_layer_id in layer_ids or signature.referencing_layer_id in layer_ids:
+                self.remove_map_layer_actions(relation_id)
+                self.child_indexes.remove(relation_id)
+        for layer_id in layer_ids:
+            if layer_id in self.layer_tree_actions:
+                self.remove_layer_tree_action(layer_id)
+
+    def relation_signature(self, relation: QgsRelation, custom_aggregates: [CustomAggregate]) -> RelationSignature:
+        """
+        Returns everything the actions of a relation are built from,
+        the actions are only recreated if the signature changes.
+        """
+        return RelationSignature(
+            relation.id(),
+            relation.name(),
+            relation.referencedLayer().id(),
+            relation.referencedLayer().name(),
+            relation.referencingLayer().id(),
+            relation.referencingLayer().name(),
+            tuple(relation.fieldPairs().items()),
+            tuple([(ca.title, ca.aggregate, ca.field, ca.order_field, ca.limit, ca.comparison, ca.threshold)
+                   for ca in custom_aggregates])
+        )
 
     def load_relations(self):
-        self.unload_relations()
+        """
+        Synchronizes the actions with the relations of the project,
+        only the actions of the relations and layers which changed are recreated.
+        """
+        instrumentation = self.instrumentation('Load relations')
+        with instrumentation.phase('synchronization'):
+            self.synchronize_relations(instrumentation)
+        instrumentation.log()
+
+    def synchronize_relations(self, instrumentation: Instrumentation):
+        relations = {}
+        for relation in relation_index().relations().values():
+            if relation.isValid():
+                relations[relation.id()] = relation
+
+        signatures = {}
+        for relation_id, relation in relations.items():
+            signatures[relation_id] = self.relation_signature(relation, self.aggregates_by_relation.get(relation_id, []))
+
+        # Map layer actions
+        for relation_id, (signature, _) in list(self.map_layer_actions.items()):
+            if signatures.get(relation_id) != signature:
+                self.remove_map_layer_actions(relation_id)
+                self.child_indexes.remove(relation_id)
+                instrumentation.count('relations removed')
+        for relation_id, relation in relations.items():
+            if relation_id not in self.map_layer_actions:
+                actions = self.add_relation_map_layer_actions(relation, self.aggregates_by_relation.get(relation_id, []))
+                self.map_layer_actions[relation_id] = (signatures[relation_id], actions)
+                instrumentation.count('relations added')
+                instrumentation.count('map layer actions added', len(actions))
 
         # Layer tree menu
-        for layer in QgsProject.instance().mapLayers().values():
-            if layer.type() != QgsMapLayerType.VectorLayer:
-                continue
+        # layer id => (ids of the relations referencing the layer, ids of the relations referenced by the layer)
+        layer_signatures = {}
+        layers = {}
+        for relation_id, relation in relations.items():
+            for position, layer in enumerate((relation.referencedLayer(), relation.referencingLayer())):
+                layers[layer.id()] = layer
+                layer_signatures.setdefault(layer.id(), ([], []))[position].append(relation_id)
+        layer_signatures = {
+            layer_id: (tuple(children), tuple(parents)) for layer_id, (children, parents) in layer_signatures.items()
+        }
+        for layer_id, (signature, _) in list(self.layer_tree_actions.items()):
+            if layer_signatures.get(layer_id) != signature:
+                self.remove_layer_tree_action(layer_id)
+                instrumentation.count('layer menus removed')
+        for layer_id, layer_signature in layer_signatures.items():
+            if layer_id not in self.layer_tree_actions:
+                # the menu content is built from the relation ids when shown
+                menu_action = self.add_layer_tree_menu(layers[layer_id], *layer_signature)
+                self.layer_tree_actions[layer_id] = (layer_signature, menu_action)
+                instrumentation.count('layer menus added')
 
-            relations = QgsProject.instance().relationManager().referencedRelations(layer)
-            if len(relations) == 0:
-                continue
+    def add_layer_tree_menu(self, layer: QgsVectorLayer, relation_ids: [str], parent_relation_ids: [str]) -> QAction:
+        """
+        Adds the context menu entry of a layer, its content is only created when it is shown
+        :param layer: the layer
+        :param relation_ids: the ids of the relations referencing the layer
+        :param parent_relation_ids: the ids of the relations referenced by the layer
+        """
+        menu_tree_main = QMenu(self.tr("Actions for relations"), self.iface.mainWindow())
+        menu_tree_main.aboutToShow.connect(
+            lambda: self.populate_layer_tree_menu(menu_tree_main, relation_ids, parent_relation_ids)
+        )
 
-            menu_tree_main = QMenu(self.tr("Actions for relations"), self.iface.mainWindow())
+        menu_action = menu_tree_main.menuAction()
 
-            menu_tree_show = QMenu(self.tr('Show referencing features for the selected features'), menu_tree_main)
-            menu_tree_add = QMenu(self.tr('Add referencing features for the selected features'), menu_tree_main)
-            menu_tree_custom = QMenu(self.tr('Custom aggregates'), menu_tree_main)
+        self.iface.addCustomActionForLayerType(menu_action, None, QgsMapLayer.VectorLayer, False)
+        self.iface.addCustomActionForLayer(menu_action, layer)
 
-            for relation in relations:
-                # show referencing features
-                title = self.tr('Show features in referencing layer "{referencing}"').format(
-                    referencing=relation.referencingLayer().name(), referenced=relation.referencedLayer().name()
-                )
-                self.create_menu_action(menu_tree_show, title, relation, self.show_children)
-                # batch insert
-                title = self.tr('Add features in referencing layer "{layer}"').format(
-                    layer=relation.referencingLayer().name(), rel=relation.name()
-                )
-                self.create_menu_action(menu_tree_add, title, relation, self.batch_insert)
+        return menu_action
+
+    def populate_layer_tree_menu(self, menu_tree_main: QMenu, relation_ids: [str], parent_relation_ids: [str]):
+        for action in menu_tree_main.actions():
+            if action.menu():
+                action.menu().deleteLater()
+        menu_tree_main.clear()
+
+        menu_tree_show = QMenu(self.tr('Show referencing features for the selected features'), menu_tree_main)
+        menu_tree_select = QMenu(self.tr('Select referencing features for the selected features'), menu_tree_main)
+        menu_tree_add = QMenu(self.tr('Add referencing features for the selected features'), menu_tree_main)
+        menu_tree_export = QMenu(self.tr('Export referencing features of the selected features'), menu_tree_main)
+        menu_tree_custom = QMenu(self.tr('Custom aggregates'), menu_tree_main)
+        menu_tree_parents = QMenu(self.tr('Referenced features of the selected features'), menu_tree_main)
+
+        relations = []
+        for relation_id in relation_ids:
+            relation = relation_index().relation(relation_id)
+            if relation is None or not relation.isValid():
+                continue
+            # show referencing features
+            title = self.tr('Show features in referencing layer "{referencing}"').format(
+                referencing=relation.referencingLayer().name(), referenced=relation.referencedLayer().name()
+            )
+            self.create_menu_action(menu_tree_show, title, relation, self.show_children)
+            # select referencing features
+            title = self.tr('Select features in referencing layer "{layer}"').format(
+                layer=relation.referencingLayer().name()
+            )
+            self.create_menu_action(menu_tree_select, title, relation, self.select_children)
+            # export referencing features
+            title = self.tr('Export features of referencing layer "{layer}"').format(
+                layer=relation.referencingLayer().name()
+            )
+            self.create_menu_action(menu_tree_export, title, relation, self.export_children)
+            # batch insert
+            title = self.tr('Add features in referencing layer "{layer}"').format(
+                layer=relation.referencingLayer().name(), rel=relation.name()
+            )
+            self.create_menu_action(menu_tree_add, title, relation, self.batch_insert)
+            relations.append(relation)
 
             # add custom aggregates
-            relation_ids = [relation.id() for relation in relations]
-            for custom_aggregate in self.custom_aggregates:
-                if custom_aggregate.relation_id in relation_ids:
-                    data = [custom_aggregate.aggregate, custom_aggregate.field]
-                    self.create_menu_action(menu_tree_custom, custom_aggregate.title, relation, self.run_aggregate, data)
+            for custom_aggregate in self.aggregates_by_relation.get(relation_id, []):
+                self.create_menu_action(
+                    menu_tree_custom, custom_aggregate.title, relation, self.run_aggregate, custom_aggregate
+                )
+
+        # batch insert in all the referencing layers
+        if len(relations) > 1:
+            menu_tree_add.addSeparator()
+            self.create_menu_action(
+                menu_tree_add, self.tr('Add features in all referencing layers'), relations[0],
+                lambda relation, feature_ids, data: self.batch_insert_relations(data, feature_ids), relations
+            )
+
+        if len(relations):
+            menu_tree_show.addSeparator()
+            self.create_menu_action(
+                menu_tree_show, self.tr('Show all descendants'), relations[0],
+                lambda relation, feature_ids, data: self.show_descendants(relation.referencedLayer(), feature_ids)
+            )
+
+        for relation_id in parent_relation_ids:
+            relation = relation_index().relation(relation_id)
+            if relation is None or not relation.isValid():
+                continue
+            title = self.tr('Show features in referenced layer "{layer}"').format(layer=relation.referencedLayer().name())
+            self.create_menu_action(menu_tree_parents, title, relation, self.show_parents, referencing=True)
+            title = self.tr('Select features in referenced layer "{layer}"').format(
+                layer=relation.referencedLayer().name()
+            )
+            self.create_menu_action(menu_tree_parents, title, relation, self.select_parents, referencing=True)
 
+        if len(relations):
             menu_tree_main.addMenu(menu_tree_show)
+            menu_tree_main.addMenu(menu_tree_select)
             menu_tree_main.addMenu(menu_tree_add)
-            if len(menu_tree_custom.actions()):
-                menu_tree_main.addMenu(menu_tree_custom)
+            menu_tree_main.addMenu(menu_tree_export)
+        if len(menu_tree_custom.actions()):
+            menu_tree_main.addMenu(menu_tree_custom)
+        if len(menu_tree_parents.actions()):
+            menu_tree_main.addMenu(menu_tree_parents)
 
-            menu_action = menu_tree_main.menuAction()
+    def add_relation_map_layer_actions(self, relation: QgsRelation, custom_aggregates: [CustomAggregate]) -> [QgsMapLayerAction]:
+        actions = []
+        # show children
+        actions.append(self.add_map_layer_action(
+            self.tr('Show referencing features in "{layer}" for relation "{rel}"')
+                .format(layer=relation.referencingLayer().name(), rel=relation.name()),
+            relation, self.show_children
+        ))
 
-            self.iface.addCustomActionForLayerType(menu_action, None, QgsMapLayer.VectorLayer, False)
-            self.iface.addCustomActionForLayer(menu_action, relation.referencedLayer())
+        # export children
+        actions.append(self.add_map_layer_action(
+            self.tr('Export referencing features in "{layer}" for relation "{rel}"')
+                .format(layer=relation.referencingLayer().name(), rel=relation.name()),
+            relation, self.export_children
+        ))
 
-            self.layer_tree_actions.append(menu_action)
+        # select children
+        actions.append(self.add_map_layer_action(
+            self.tr('Select referencing features in "{layer}" for relation "{rel}"')
+                .format(layer=relation.referencingLayer().name(), rel=relation.name()),
+            relation, self.select_children
+        ))
 
-        # Map layer actions
-        for relation in QgsProject.instance().relationManager().relations().values():
-            # show children
-            self.add_map_layer_action(
-                self.tr('Show referencing features in "{layer}" for relation "{rel}"')
-                    .format(layer=relation.referencingLayer().name(), rel=relation.name()),
-                relation, self.show_children
+        # batch insert
+        actions.append(self.add_map_layer_action(
+            self.tr('Add features in referencing layer "{layer}" for "relation "{rel}"')
+                .format(layer=relation.referencingLayer().name(), rel=relation.name()),
+            relation, self.batch_insert
+        ))
+        # add custom aggregates
+        for custom_aggregate in custom_aggregates:
+            actions.append(
+                self.add_map_layer_action(custom_aggregate.title, relation, self.run_aggregate, custom_aggregate)
             )
 
-            # batch insert
-            self.add_map_layer_action(
-                self.tr('Add features in referencing layer "{layer}" for "relation "{rel}"')
-                    .format(layer=relation.referencingLayer().name(), rel=relation.name()),
-                relation, self.batch_insert
-            )
-            # add custom aggregates
-            for custom_aggregate in self.custom_aggregates:
-                if custom_aggregate.relation_id == relation.id():
-                    data = [custom_aggregate.aggregate, custom_aggregate.field]
-                    self.add_map_layer_action(custom_aggregate.title, relation, self.run_aggregate, data)
+        # reverse lookup, on the referencing layer
+        actions.append(self.add_map_layer_action(
+            self.tr('Show referenced features in "{layer}" for relation "{rel}"')
+                .format(layer=relation.referencedLayer().name(), rel=relation.name()),
+            relation, self.show_parents, referencing=True
+        ))
+        actions.append(self.add_map_layer_action(
+            self.tr('Select referenced features in "{layer}" for relation "{rel}"')
+                .format(layer=relation.referencedLayer().name(), rel=relation.name()),
+            relation, self.select_parents, referencing=True
+        ))
+        return actions
 
-    def add_map_layer_action(self, title: str, relation: QgsRelation, slot, data=None) -> QgsMapLayerAction:
+    def add_map_layer_action(self, title: str, relation: QgsRelation, slot, data=None,
+                             referencing: bool = False) -> QgsMapLayerAction:
+        """
+        :param referencing: if True, the action is added to the referencing layer instead of the referenced one
+        """
+        action_layer = relation.referencingLayer() if referencing else relation.referencedLayer()
 
         def layer_action_triggered(layer: QgsVectorLayer, features: [QgsFeature]):
-            assert layer == relation.referencedLayer()
-            slot(relation, features, data)
+            assert layer == action_layer
+            slot(relation, [feature.id() for feature in features], data)
 
         action = QgsMapLayerAction(
             title,
             self.iface.mainWindow(),
-            relation.referencedLayer(),
+            action_layer,
             QgsMapLayerAction.MultipleFeatures
         )
-        if DEBUG:
-            print('Adding insert action for relation "{}" in layer "{}"'.format(relation.name(),
-                                                                         relation.referencedLayer().name()))
         QgsGui.instance().mapLayerActionRegistry().addMapLayerAction(action)
         action.triggeredForFeatures.connect(layer_action_triggered)
-        self.map_layer_actions.append(action)
+        return action
 
     @staticmethod
-    def create_menu_action(parent_menu: QMenu, title: str, relation: QgsRelation, slot, data=None):
+    def create_menu_action(parent_menu: QMenu, title: str, relation: QgsRelation, slot, data=None,
+                           referencing: bool = False):
         # add legend context menu entry
         action = QAction(title, parent_menu)
         action.setData(relation.id())
-        action.triggered.connect(lambda: slot(relation, relation.referencedLayer().selectedFeatures(), data))
+        layer = relation.referencingLayer() if referencing else relation.referencedLayer()
+        action.triggered.connect(lambda: slot(relation, list(layer.selectedFeatureIds()), data))
         parent_menu.addAction(action)
 
-    def show_children(self, relation: QgsRelation, features: [QgsFeature], data=None):
+    def instrumentation(self, action: str) -> Instrumentation:
+        return Instrumentation(action, self.settings.value('instrumentation'))
+
+    def cancel_tasks(self):
+        """
+        Cancels the running tasks, their results are dropped
+        """
+        for task in self.tasks:
+            task.taskCompleted.disconnect()
+            task.taskTerminated.disconnect()
+            # keep a reference until the task ends, the task manager does not own the Python object
+            task.taskCompleted.connect(lambda t=task: self.tasks.remove(t))
+            task.taskTerminated.connect(lambda t=task: self.tasks.remove(t))
+            task.cancel()
+
+    def run_task(self, task: ReferencedKeysTask, on_completed, completion_phase: str = None, on_terminated=None):
+        """
+        Runs a task in the task manager and calls on_completed(task) in the GUI thread once it is completed
+        :param completion_phase: if given, on_completed is timed under this phase name
+        :param on_terminated: if given, on_terminated(task) is called if the task fails or is canceled
+        """
+        # keep a reference to the task, the task manager does not own the Python object
+        self.tasks.append(task)
+
+        def completed():
+            self.tasks.remove(task)
+            if completion_phase:
+                with task.instrumentation.phase(completion_phase):
+                    on_completed(task)
+            else:
+                on_completed(task)
+            task.instrumentation.log()
+
+        def terminated():
+            self.tasks.remove(task)
+            task.instrumentation.log()
+            if on_terminated:
+                on_terminated(task)
+            if task.exception:
+                self.iface.messageBar().pushMessage(
+                    'Actions for relations',
+                    self.tr('Error while running "{task}": {error}').format(task=task.description(), error=task.exception),
+                    Qgis.Critical
+                )
+
+        task.taskCompleted.connect(completed)
+        task.taskTerminated.connect(terminated)
+        QgsApplication.taskManager().addTask(task)
+
+    def run_with_child_index(self, relation: QgsRelation, feature_ids: [int], instrumentation: Instrumentation,
+                             resolve, field_index: int = None, on_resolved=None):
+        """
+        Resolves the referencing features through the child index of the relation and shows them.
+        The index is built on first use, in the same task as the key collection,
+        actions started meanwhile only collect their keys and wait for this build.
+        :param resolve: resolve(index, parent_keys) returns the referencing feature ids, called in the GUI thread
+        :param field_index: a field which must be indexed for the aggregates
+        :param on_resolved: on_resolved(fids) is called with the referencing feature ids instead of showing them
+        """
+        layer = relation.referencingLayer()
+        field_indexes = [layer.fields().indexFromName(custom_aggregate.field)
+                         for custom_aggregate in self.aggregates_by_relation.get(relation.id(), [])
+                         if custom_aggregate.aggregate in EXTREMUM_AGGREGATES]
+        if field_index is not None:
+            field_indexes.append(field_index)
+        index = self.child_indexes.index(relation, [index for index in field_indexes if index >= 0])
+
+        if index.is_built() or index.is_building():
+            # while the index is being built by another action, only the keys are collected
+            task = ReferencedKeysTask(instrumentation.action, relation, feature_ids, instrumentation)
+        else:
+            index.start_building()
+            task = ChildIndexTask(relation, feature_ids, index.field_indexes, instrumentation)
+
+        def lookup(t: ReferencedKeysTask):
+            with instrumentation.phase('index lookup'):
+                fids = resolve(index, t.parent_keys())
+            instrumentation.count('referencing features', len(fids))
+            if on_resolved:
+                with instrumentation.phase('selection'):
+                    on_resolved(fids)
+            else:
+                with instrumentation.phase('table opening'):
+                    self.show_features(layer, fids)
+
+        def completed(t: ReferencedKeysTask):
+            pending_lookups = []
+            if not index.is_built():
+                if isinstance(t, ChildIndexTask):
+                    pending_lookups = index.install(t.index_data)
+                elif index.is_building():
+                    # resolved once the index is installed, before it can be released
+                    index.queue_lookup(lambda: lookup(t))
+                    return
+                else:
+                    # the index was invalidated while the keys were collected, it is built again
+                    instrumentation.count('index rebuilds')
+                    self.run_with_child_index(relation, feature_ids, instrumentation, resolve, field_index, on_resolved)
+                    return
+            lookup(t)
+            for pending_lookup in pending_lookups:
+                pending_lookup()
+            index.release_if_stale()
+            self.child_indexes.enforce_budget()
+
+        def terminated(t: ReferencedKeysTask):
+            if isinstance(t, ChildIndexTask):
+                index.abort_building()
+
+        self.run_task(task, completed, on_terminated=terminated)
+
+    def show_children(self, relation: QgsRelation, feature_ids: [int], data=None):
         """
         :param relation: the relation
-        :param features: the list of feature on the referenced layer
+        :param feature_ids: the ids of the features on the referenced layer
         :return:
         """
-        if len(features) == 0:
+        if len(feature_ids) == 0:
+            return
+
+        instrumentation = self.instrumentation('Show referencing features of "{}"'.format(relation.name()))
+        if self.settings.value('child_index'):
+            self.run_with_child_index(
+                relation, feature_ids, instrumentation, lambda index, parent_keys: index.feature_ids(parent_keys)
+            )
+            return
+
+        # the results dock pages through feature ids, which are always resolved if it is enabled
+        # and above the threshold, where the expression would be too large for the attribute table
+        task = ReferencingFeaturesTask(
+            relation, feature_ids, self.settings.value('fid_filter_threshold'), instrumentation,
+            fids_only=self.settings.value('results_dock')
+        )
+        self.run_task(
+            task,
+            lambda t: self.show_features(relation.referencingLayer(), t.fids, t.expression, t.fids is not None),
+            'table opening'
+        )
+
+    def select_children(self, relation: QgsRelation, feature_ids: [int], data=None):
+        """
+        Selects the referencing features without opening any table.
+        As for the selection tools, Shift adds to the selection, Ctrl removes from it and Ctrl+Shift intersects it.
+        :param relation: the relation
+        :param feature_ids: the ids of the features on the referenced layer
+        """
+        if len(feature_ids) == 0:
+            return
+
+        layer = relation.referencingLayer()
+        behavior = selection_behavior(QApplication.keyboardModifiers())
+        instrumentation = self.instrumentation('Select referencing features of "{}"'.format(relation.name()))
+        if self.settings.value('child_index'):
+            self.run_with_child_index(
+                relation, feature_ids, instrumentation, lambda index, parent_keys: index.feature_ids(parent_keys),
+                on_resolved=lambda fids: layer.selectByIds(fids, behavior)
+            )
+            return
+
+        task = ReferencingFeaturesTask(relation, feature_ids, 0, instrumentation, fids_only=True)
+        self.run_task(task, lambda t: layer.selectByIds(t.fids, behavior), 'selection')
+
+    def export_children(self, relation: QgsRelation, feature_ids: [int], data=None):
+        """
+        Exports the referencing features to a file in a task
+        :param relation: the relation
+        :param feature_ids: the ids of the features on the referenced layer
+        """
+        if len(feature_ids) == 0:
+            return
+        dlg = ExportDialog(self.iface.mainWindow())
+        if not dlg.exec_():
+            return
+        path = dlg.path()
+        task = ExportTask(
+            relation, feature_ids, path, dlg.driver(), dlg.parent_key_field(),
+            self.instrumentation('Export referencing features of "{}"'.format(relation.name()))
+        )
+
+        def completed(t: ExportTask):
+            self.iface.messageBar().pushMessage(
+                'Actions for relations',
+                self.tr('{count} features were exported to {path}').format(count=t.count, path=path)
+            )
+
+        self.run_task(task, completed)
+
+    def show_descendants(self, layer: QgsVectorLayer, feature_ids: [int]):
+        """
+        Shows the descendants of the features through all the relations reachable from the layer
+        :param layer: the referenced layer
+        :param feature_ids: the ids of the features on the layer
+        """
+        if len(feature_ids) == 0:
             return
+        task = DescendantsTask(layer, feature_ids, self.instrumentation('Show descendants of "{}"'.format(layer.name())))
+
+        def completed(t: DescendantsTask):
+            counts = []
+            for layer_id, fids in t.descendants.items():
+                descendant_layer = QgsProject.instance().mapLayer(layer_id)
+                if descendant_layer is None:
+                    continue
+                counts.append('"{}": {}'.format(descendant_layer.name(), len(fids)))
+                # the results dock shows a single layer, one attribute table is opened per layer instead
+                self.iface.showAttributeTable(descendant_layer, fid_filter_expression(fids))
+            message = self.tr('Descendants found: {counts}').format(counts=', '.join(counts) or '0')
+            if len(t.cycles):
+                message += ' ' + self.tr('(cycles through relations {relations} were stopped)').format(
+                    relations=', '.join(['"{}"'.format(relation.name()) for relation in t.cycles])
+                )
+            self.iface.messageBar().pushMessage('Actions for relations', message, Qgis.Info)
 
-        # works only for single key relation
-        for referencing, referenced in relation.fieldPairs().items():
-            break
-        expression = '{fk} IN ({parent_ids})'.format(
-            fk=referencing,
-            parent_ids=', '.join(
-                ["{escape_referenced}{referenced}{escape_referenced}".format(
-                    referenced=str(f.attribute(referenced)),
-                    escape_referenced="'" if not relation.referencedLayer().fields().field(referenced).isNumeric() else ''
-                ) for f in features]
+        self.run_task(task, completed, 'table opening')
+
+    def show_parents(self, relation: QgsRelation, feature_ids: [int], data=None):
+        """
+        Shows the referenced features of the given features of the referencing layer
+        :param relation: the relation
+        :param feature_ids: the ids of the features on the referencing layer
+        """
+        if len(feature_ids) == 0:
+            return
+        task = ReferencedFeaturesTask(
+            relation, feature_ids, self.instrumentation('Show referenced features of "{}"'.format(relation.name()))
+        )
+        self.run_task(task, lambda t: self.show_features(relation.referencedLayer(), t.fids), 'table opening')
+
+    def select_parents(self, relation: QgsRelation, feature_ids: [int], data=None):
+        """
+        Selects the referenced features of the given features of the referencing layer
+        :param relation: the relation
+        :param feature_ids: the ids of the features on the referencing layer
+        """
+        if len(feature_ids) == 0:
+            return
+        behavior = selection_behavior(QApplication.keyboardModifiers())
+        task = ReferencedFeaturesTask(
+            relation, feature_ids, self.instrumentation('Select referenced features of "{}"'.format(relation.name()))
+        )
+        self.run_task(task, lambda t: relation.referencedLayer().selectByIds(t.fids, behavior), 'selection')
+
+    def check_integrity(self):
+        """
+        Finds the orphan referencing features and the childless referenced features of all the relations,
+        running one task per relation
+        """
+        relations = [relation for relation in relation_index().relations().values() if relation.isValid()]
+        if len(relations) == 0:
+            self.iface.messageBar().pushMessage(
+                'Actions for relations', self.tr('There is no relation in the project'), Qgis.Warning
+            )
+            return
+
+        completed_tasks = []
+        pending = [len(relations)]
+
+        def finished(task: IntegrityTask, completed: bool):
+            if completed:
+                completed_tasks.append(task)
+            pending[0] -= 1
+            if pending[0] == 0:
+                self.report_integrity(completed_tasks, len(relations))
+
+        for relation in relations:
+            task = IntegrityTask(
+                relation, self.instrumentation('Check integrity of "{}"'.format(relation.name()))
             )
+            self.run_task(task, lambda t: finished(t, True), on_terminated=lambda t: finished(t, False))
+
+    def report_integrity(self, tasks: [IntegrityTask], relation_count: int):
+        """
+        Logs the result of each relation and shows a summary, from which the orphans can be selected
+        """
+        # referencing layer id => orphan ids
+        orphans = {}
+        orphan_count = 0
+        childless_count = 0
+        for task in tasks:
+            relation = task.relation
+            QgsMessageLog.logMessage(
+                self.tr('Relation "{relation}": {orphans} orphan features in "{referencing}", '
+                        '{childless} features without referencing features in "{referenced}"').format(
+                    relation=relation.name(), orphans=len(task.orphans), childless=len(task.childless),
+                    referencing=relation.referencingLayer().name(), referenced=relation.referencedLayer().name()
+                ),
+                LOG_TAG, Qgis.Warning if task.orphans else Qgis.Info
+            )
+            if task.orphans:
+                orphans.setdefault(relation.referencingLayer().id(), set()).update(task.orphans)
+            orphan_count += len(task.orphans)
+            childless_count += len(task.childless)
+
+        text = self.tr('{checked} of {count} relations checked: {orphans} orphan features, '
+                       '{childless} features without referencing features, see the message log for details').format(
+            checked=len(tasks), count=relation_count, orphans=orphan_count, childless=childless_count
         )
-        self.iface.showAttributeTable(relation.referencingLayer(), expression)
+        message = self.iface.messageBar().createMessage(self.tr('Referential integrity'), text)
+        if orphan_count:
+            button = QPushButton(self.tr('Select orphans'), message)
+
+            def select_orphans():
+                for layer_id, fids in orphans.items():
+                    layer = QgsProject.instance().mapLayer(layer_id)
+                    if layer is not None:
+                        layer.selectByIds(list(fids))
+
+            button.clicked.connect(select_orphans)
+            message.layout().addWidget(button)
+        self.iface.messageBar().pushWidget(message, Qgis.Warning if orphan_count else Qgis.Success)
+
+    def show_features(self, layer: QgsVectorLayer, fids: [int] = None, expression: str = None,
+                      results_dock: bool = False):
+        """
+        Shows the features in the results dock if enabled, in the attribute table otherwise
+        :param fids: the feature ids, if resolved
+        :param expression: the filter expression, computed from the feature ids if not given
+        :param results_dock: if True, the resolved features are shown in the results dock even if not enabled
+        """
+        if fids is not None and (results_dock or self.settings.value('results_dock')):
+            if self.results_dock is None:
+                self.results_dock = ResultsDock(self.iface, self.iface.mainWindow())
+                self.iface.addDockWidget(Qt.BottomDockWidgetArea, self.results_dock)
+            self.results_dock.show_features(layer, fids)
+        else:
+            self.iface.showAttributeTable(layer, expression or fid_filter_expression(fids))
 
-    def batch_insert(self, relation: QgsRelation, features: [QgsFeature], data=None):
+    def batch_insert(self, relation: QgsRelation, feature_ids: [int], data=None):
         """
         :param relation: the relation
-        :param features: the list of feature on the referenced layer
+        :param feature_ids: the ids of the features on the referenced layer
         :return:
         """
         layer = relation.referencingLayer()
@@ -208,7 +779,7 @@ class ActionsForRelationsPlugin(QObject):
             )
             return
 
-        if len(features) < 1:
+        if len(feature_ids) < 1:
             self.iface.messageBar().pushMessage(
                 'Relation Batch Insert',
                 self.tr('There is no features to batch insert for. Select some in layer "{layer}" first.')
@@ -217,43 +788,49 @@ class ActionsForRelationsPlugin(QObject):
             )
             return
 
-        default_values = {}
-        orignal_cfg = {}
-        first_feature_created = False
-        referencing_feature = QgsFeature()
-        features_written = 0
-        ok = True
+        task = ReferencedKeysTask(
+            self.tr('Collecting referenced keys in "{layer}"').format(layer=relation.referencedLayer().name()),
+            relation, feature_ids, self.instrumentation('Batch insert for "{}"'.format(relation.name()))
+        )
+        self.run_task(task, lambda t: self.insert_referencing_features(relation, t.keys, t.instrumentation))
+
+    def insert_referencing_features(self, relation: QgsRelation, keys: [tuple], instrumentation: Instrumentation):
+        """
+        Shows the form for the first key and creates the features for the other keys
+        :param relation: the relation
+        :param keys: the keys of the referenced features
+        :param instrumentation: the instrumentation of the action
+        """
+        layer = relation.referencingLayer()
+        if not layer.isEditable():
+            self.iface.messageBar().pushMessage(
+                'Relation Batch Insert',
+                self.tr('layer "{layer}" is not editable').format(layer=layer.name()), Qgis.Warning
+            )
+            return
+        if len(keys) < 1:
+            return
 
-        for referenced_feature in features:
-            # define values for the referencing field over the possible several field pairs
-            for referencing_field, referenced_field in relation.fieldPairs().items():
-                referencing_field_index = relation.referencingLayer().fields().indexFromName(referencing_field)
+        ok, referencing_feature = self.referencing_feature_form(relation, keys[0], instrumentation)
+        features_written = 1 if ok else 0
 
-                # disabled the widgets for the referenced feature in the form (since it will be replaced)
-                if not first_feature_created:
-                    default_values[referencing_field_index] = referenced_feature[referenced_field]
-                    orignal_cfg[referencing_field_index] = layer.editorWidgetSetup(referencing_field_index)
-                    layer.setEditorWidgetSetup(referencing_field_index, QgsEditorWidgetSetup('Hidden', {}))
+        if ok and len(keys) > 1:
+            new_features = self.create_features_with_progress(relation, referencing_feature, keys[1:], instrumentation)
+            if new_features is None:
+                self.iface.messageBar().pushMessage(
+                    'Relation Batch Insert',
+                    self.tr('Batch insert canceled, {count} features were written to "{layer}"').format(
+                        count=features_written, layer=layer.name()
+                    ),
+                    Qgis.Warning
+                )
+                return
 
-                else:
-                    # it has been created at previous iteration
-                    referencing_feature[referencing_field_index] = referenced_feature[referenced_field]
-
-            if not first_feature_created:
-                # show form for the feature with disabled widgets for the referencing fields
-                ok, referencing_feature = self.iface.vectorLayerTools().addFeature(layer, default_values, QgsGeometry())
-                if not ok:
-                    break
-                # restore widget config of the layer
-                for index, cfg in orignal_cfg.items():
-                    layer.setEditorWidgetSetup(index, cfg)
-                first_feature_created = True
-            else:
-                ok = layer.addFeature(referencing_feature)
-                if not ok:
-                    break
-            features_written += 1
+            ok = self.add_features(layer, new_features, instrumentation)
+            if ok:
+                features_written += len(new_features)
 
+        instrumentation.count('features written', features_written)
         if ok:
             self.iface.messageBar().pushMessage(
                 'Relation Batch Insert',
@@ -267,37 +844,218 @@ class ActionsForRelationsPlugin(QObject):
                         '{expected_count} were expected.').format(
                     count=features_written,
                     layer=layer.name(),
-                    expected_count=len(features)
+                    expected_count=len(keys)
                 ),
                 Qgis.Critical
             )
 
-    def run_aggregate(self, relation: QgsRelation, features: [QgsFeature], data=None):
-        if len(features) == 0:
+    def batch_insert_relations(self, relations: [QgsRelation], feature_ids: [int]):
+        """
+        Adds features in the referencing layers of several relations sharing the referenced layer,
+        with one form per relation. Either all the features are added or none.
+        :param relations: the relations
+        :param feature_ids: the ids of the features on the referenced layer
+        """
+        not_editable = [relation.referencingLayer().name() for relation in relations
+                        if not relation.referencingLayer().isEditable()]
+        if len(not_editable):
+            self.iface.messageBar().pushMessage(
+                'Relation Batch Insert',
+                self.tr('layers {layers} are not editable').format(
+                    layers=', '.join(['"{}"'.format(name) for name in not_editable])
+                ),
+                Qgis.Warning
+            )
+            return
+
+        if len(feature_ids) < 1:
+            self.iface.messageBar().pushMessage(
+                'Relation Batch Insert',
+                self.tr('There is no features to batch insert for. Select some in layer "{layer}" first.')
+                    .format(layer=relations[0].referencedLayer().name()),
+                Qgis.Warning
+            )
             return
 
-        conditions = []
-        for referencing, referenced in relation.fieldPairs().items():
-            break
+        task = RelationsKeysTask(
+            self.tr('Collecting referenced keys in "{layer}"').format(layer=relations[0].referencedLayer().name()),
+            relations, feature_ids,
+            self.instrumentation('Batch insert for {} relations of "{}"'.format(
+                len(relations), relations[0].referencedLayer().name()
+            ))
+        )
+        self.run_task(
+            task, lambda t: self.insert_features_in_relations(relations, t.keys_by_relation, t.instrumentation)
+        )
+
+    def insert_features_in_relations(self, relations: [QgsRelation], keys_by_relation: dict,
+                                     instrumentation: Instrumentation):
+        """
+        Shows the form of each relation, then creates and adds the features of all the relations.
+        If anything fails or is canceled, the features already added are undone.
+        In transaction mode, the layers of a transaction group share the same database transaction.
+        :param relations: the relations
+        :param keys_by_relation: relation id => keys of the referenced features
+        :param instrumentation: the instrumentation of the action
+        """
+        # layers having an undo step for the form and possibly one for the batch
+        undo_steps = []
+
+        def rollback():
+            for layer, steps in reversed(undo_steps):
+                for _ in range(steps):
+                    layer.undoStack().undo()
+
+        templates = []
+        for relation in relations:
+            keys = keys_by_relation.get(relation.id(), [])
+            if len(keys) < 1:
+                continue
+            layer = relation.referencingLayer()
+            if not layer.isEditable():
+                rollback()
+                return
+            ok, referencing_feature = self.referencing_feature_form(relation, keys[0], instrumentation)
+            if not ok:
+                rollback()
+                return
+            undo_steps.append((layer, 1))
+            templates.append((relation, referencing_feature, keys))
 
-        field = relation.referencedLayer().fields().field(referenced)
-        quote = "" if field.isNumeric() else "'"
+        features_by_relation = []
+        for relation, referencing_feature, keys in templates:
+            new_features = self.create_features_with_progress(relation, referencing_feature, keys[1:], instrumentation)
+            if new_features is None:
+                rollback()
+                self.iface.messageBar().pushMessage(
+                    'Relation Batch Insert', self.tr('Batch insert canceled, no features were written'), Qgis.Warning
+                )
+                return
+            features_by_relation.append((relation, new_features))
 
-        for feature in features:
-            base_condition = '{fk} = {quote}{parent_id}{quote}'.format(
-                fk=referencing,
-                parent_id=feature.attribute(referenced),
-                quote=quote,
+        features_written = 0
+        for position, (relation, new_features) in enumerate(features_by_relation):
+            layer = relation.referencingLayer()
+            if len(new_features) and not self.add_features(layer, new_features, instrumentation):
+                rollback()
+                self.iface.messageBar().pushMessage(
+                    'Relation Batch Insert',
+                    self.tr('There was an error while inserting features in "{layer}", '
+                            'no features were written').format(layer=layer.name()),
+                    Qgis.Critical
+                )
+                return
+            if len(new_features):
+                undo_steps[position] = (layer, 2)
+            features_written += len(new_features) + 1
+
+        instrumentation.count('features written', features_written)
+        self.iface.messageBar().pushMessage(
+            'Relation Batch Insert',
+            self.tr('{count} features were written to {layers}').format(
+                count=features_written,
+                layers=', '.join(['"{}"'.format(relation.referencingLayer().name()) for relation, _ in features_by_relation])
             )
-            condition = "( {filter} AND {field} = aggregate(layer:='{lyr}', aggregate:='{agg}', expression:={field}, filter:={filter}) )".format(
-                filter=base_condition,
-                field=data[1],
-                lyr=relation.referencingLayer().id(),
-                agg=data[0]
+        )
+
+    def referencing_feature_form(self, relation: QgsRelation, key: tuple,
+                                 instrumentation: Instrumentation) -> (bool, QgsFeature):
+        """
+        Shows the form to add a referencing feature for the given key,
+        the widgets of the referencing fields are hidden since they are filled automatically.
+        """
+        layer = relation.referencingLayer()
+        referencing_indexes = relation_index().relation_key(relation).referencing_indexes
+
+        default_values = {}
+        orignal_cfg = {}
+        for position, referencing_field_index in enumerate(referencing_indexes):
+            default_values[referencing_field_index] = key[position] if key else None
+            orignal_cfg[referencing_field_index] = layer.editorWidgetSetup(referencing_field_index)
+            layer.setEditorWidgetSetup(referencing_field_index, QgsEditorWidgetSetup('Hidden', {}))
+        with instrumentation.phase('form'):
+            ok, referencing_feature = self.iface.vectorLayerTools().addFeature(layer, default_values, QgsGeometry())
+        # restore widget config of the layer
+        for index, cfg in orignal_cfg.items():
+            layer.setEditorWidgetSetup(index, cfg)
+        return ok, referencing_feature
+
+    def create_features_with_progress(self, relation: QgsRelation, template: QgsFeature, keys: [tuple],
+                                      instrumentation: Instrumentation) -> [QgsFeature]:
+        """
+        Creates the referencing features for the given keys, copying the attributes of the template
+        :return: the features or None if canceled
+        """
+        if len(keys) < 1:
+            return []
+        layer = relation.referencingLayer()
+        progress = QProgressDialog(
+            self.tr('Creating features in "{layer}"').format(layer=layer.name()),
+            self.tr('Cancel'), 0, 100, self.iface.mainWindow()
+        )
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(1000)
+        feedback = QgsFeedback()
+        feedback.progressChanged.connect(lambda value: progress.setValue(int(value)))
+        progress.canceled.connect(feedback.cancel)
+
+        with instrumentation.phase('feature creation'):
+            new_features = create_referencing_features(
+                layer, template, relation_index().relation_key(relation).referencing_indexes, keys, feedback
             )
-            conditions.append(condition)
-        expression = ' OR '.join(conditions)
-        self.iface.showAttributeTable(relation.referencingLayer(), expression)
+        canceled = feedback.isCanceled()
+        progress.close()
+        return None if canceled else new_features
+
+    def add_features(self, layer: QgsVectorLayer, features: [QgsFeature], instrumentation: Instrumentation) -> bool:
+        """
+        Adds the features at once, as a single undo step and a single provider write in transaction mode
+        """
+        with instrumentation.phase('edit commit'):
+            layer.beginEditCommand(self.tr('Batch insert in "{layer}"').format(layer=layer.name()))
+            ok = False
+            try:
+                ok = layer.addFeatures(features)
+            finally:
+                if ok:
+                    layer.endEditCommand()
+                else:
+                    layer.destroyEditCommand()
+        return ok
 
+    def run_aggregate(self, relation: QgsRelation, feature_ids: [int], custom_aggregate: CustomAggregate = None):
+        if len(feature_ids) == 0:
+            return
+        if not custom_aggregate.is_valid():
+            self.iface.messageBar().pushMessage(
+                'Actions for relations',
+                self.tr('Aggregate "{title}" cannot be computed on field "{field}" of "{layer}"').format(
+                    title=custom_aggregate.title, field=custom_aggregate.field,
+                    layer=relation.referencingLayer().name()
+                ),
+                Qgis.Warning
+            )
+            return
 
+        instrumentation = self.instrumentation('Aggregate {}({}) on "{}"'.format(
+            custom_aggregate.aggregate, custom_aggregate.field, relation.name())
+        )
+        field_index = relation.referencingLayer().fields().indexFromName(custom_aggregate.field)
+        # the child index only keeps the extremes of the children
+        if self.settings.value('child_index') and field_index >= 0 \
+                and custom_aggregate.aggregate in EXTREMUM_AGGREGATES:
+            self.run_with_child_index(
+                relation, feature_ids, instrumentation,
+                lambda index, parent_keys: index.aggregate_feature_ids(
+                    parent_keys, custom_aggregate.aggregate, field_index
+                ),
+                field_index
+            )
+            return
 
+        task = AggregateTask(
+            relation, feature_ids, custom_aggregate, self.settings.value('sql_pushdown'), instrumentation
+        )
+        self.run_task(
+            task, lambda t: self.show_features(relation.referencingLayer(), t.fids, t.expression), 'table opening'
+        )
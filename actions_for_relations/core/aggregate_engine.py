@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+import heapq
+import operator
+from qgis.core import QgsFeatureRequest, QgsAbstractFeatureSource, QgsFeedback
+from actions_for_relations.core.relation_key import RelationKey
+from actions_for_relations.core.utils import is_null
+
+# children whose value equals the extreme of their parent
+EXTREMUM_AGGREGATES = ('min', 'max')
+# all the children of the parents whose aggregated value passes the threshold
+THRESHOLD_AGGREGATES = ('count', 'sum', 'mean')
+# aggregates which only apply to numeric fields
+NUMERIC_AGGREGATES = ('sum', 'mean')
+# the N first or last children of each parent, by order field
+ORDERED_AGGREGATES = ('first', 'last')
+AGGREGATES = EXTREMUM_AGGREGATES + THRESHOLD_AGGREGATES + ORDERED_AGGREGATES
+
+COMPARISONS = {
+    '=': operator.eq,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class AggregateSpec:
+    """
+    An aggregate with its fields resolved to indexes
+    """
+    def __init__(self, aggregate: str, field_index: int, order_field_index: int = -1, limit: int = 1,
+                 comparison: str = '>', threshold: float = 0):
+        if aggregate not in AGGREGATES:
+            raise ValueError('unsupported aggregate: {}'.format(aggregate))
+        if comparison not in COMPARISONS:
+            raise ValueError('unsupported comparison: {}'.format(comparison))
+        self.aggregate = aggregate
+        self.field_index = field_index
+        # ordered aggregates fall back on the aggregated field
+        self.order_field_index = order_field_index if order_field_index >= 0 else field_index
+        self.limit = max(1, limit)
+        self.comparison = comparison
+        self.threshold = threshold
+
+    def value_index(self) -> int:
+        """
+        Returns the index of the field read for each child
+        """
+        if self.aggregate in ORDERED_AGGREGATES:
+            return self.order_field_index
+        return self.field_index
+
+
+class _ExtremumGroup:
+    __slots__ = ('value', 'fids')
+
+    def __init__(self):
+        self.value = None
+        self.fids = []
+
+    def add(self, fid: int, value, better):
+        if self.value is None or better(value, self.value):
+            self.value = value
+            self.fids = [fid]
+        elif value == self.value:
+            self.fids.append(fid)
+
+
+class _ThresholdGroup:
+    __slots__ = ('count', 'sum', 'fids')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.fids = []
+
+    def value(self, aggregate: str):
+        if aggregate == 'count':
+            return self.count
+        if aggregate == 'sum':
+            return self.sum
+        return self.sum / self.count if self.count else None
+
+
+class _Reversed:
+    """
+    Reverses the ordering of a value, to keep the smallest values in a min-heap
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def grouped_aggregate_feature_ids(
+        source: QgsAbstractFeatureSource, relation_key: RelationKey, parent_keys: set, spec: AggregateSpec,
+        feedback: QgsFeedback = None, feature_count: int = 0
+) -> [int]:
+    """
+    Scans the referencing layer once and returns the ids of the features matching the aggregate
+    computed per foreign key. Memory is bounded by the number of parents for min/max,
+    by N per parent for first/last and by the children of the parents for count/sum/mean.
+    :param source: the feature source of the referencing layer
+    :param relation_key: the key extractor of the relation
+    :param parent_keys: the set of referenced keys to consider
+    :param spec: the aggregate
+    :param feedback: an optional feedback for progress and cancellation
+    :param feature_count: the number of features of the source, used to report progress
+    """
+    value_index = spec.value_index()
+    if value_index < 0:
+        return []
+
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(list(set(relation_key.referencing_indexes + [value_index])))
+
+    aggregate = spec.aggregate
+    better = operator.lt if aggregate == 'min' else operator.gt
+
+    # foreign key => group
+    groups = {}
+    for scanned, feature in enumerate(source.getFeatures(request)):
+        if feedback and scanned % 1000 == 0:
+            if feedback.isCanceled():
+                break
+            if feature_count:
+                feedback.setProgress(100 * scanned / feature_count)
+        key = relation_key.referencing_key(feature)
+        if key not in parent_keys:
+            continue
+        value = feature.attribute(value_index)
+
+        if aggregate in EXTREMUM_AGGREGATES:
+            if is_null(value):
+                continue
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _ExtremumGroup()
+            group.add(feature.id(), value, better)
+
+        elif aggregate in THRESHOLD_AGGREGATES:
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _ThresholdGroup()
+            group.fids.append(feature.id())
+            if not is_null(value):
+                group.count += 1
+                if aggregate != 'count':
+                    group.sum += value
+
+        else:
+            if is_null(value):
+                continue
+            # bounded heap of the N kept children, its root is the next one to be dropped
+            if aggregate == 'last':
+                item = (value, feature.id())
+            else:
+                item = (_Reversed(value), _Reversed(feature.id()))
+            heap = groups.get(key)
+            if heap is None:
+                heap = groups[key] = []
+            if len(heap) < spec.limit:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+
+    fids = []
+    if aggregate in EXTREMUM_AGGREGATES:
+        for group in groups.values():
+            fids.extend(group.fids)
+    elif aggregate in THRESHOLD_AGGREGATES:
+        compare = COMPARISONS[spec.comparison]
+        for group in groups.values():
+            value = group.value(aggregate)
+            if value is not None and compare(value, spec.threshold):
+                fids.extend(group.fids)
+    else:
+        for heap in groups.values():
+            fids.extend([fid if aggregate == 'last' else fid.value for _, fid in heap])
+    return fids
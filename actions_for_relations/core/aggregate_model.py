@@ -11,6 +11,7 @@
 from enum import Enum
 from qgis.PyQt.QtCore import Qt, QObject, QAbstractTableModel, QModelIndex
 from actions_for_relations.core.custom_aggregate import CustomAggregate
+from actions_for_relations.core.relation_index import relation_index
 
 
 class Column(Enum):
@@ -18,6 +19,11 @@ class Column(Enum):
     RelationColumn = 1
     AggregateColumn = 2
     FieldColumn = 3
+    OrderFieldColumn = 4
+    LimitColumn = 5
+    ComparisonColumn = 6
+    ThresholdColumn = 7
+    ProjectColumn = 8
 
 
 class Role(Enum):
@@ -25,6 +31,8 @@ class Role(Enum):
     RelationIdRole = Qt.UserRole + 2
     AggregateRole = Qt.UserRole + 3
     FieldRole = Qt.UserRole + 4
+    OrderFieldRole = Qt.UserRole + 5
+    ComparisonRole = Qt.UserRole + 6
 
 
 class AggregateModel(QAbstractTableModel):
@@ -36,13 +44,18 @@ class AggregateModel(QAbstractTableModel):
         return len(self.custom_aggregates)
 
     def columnCount(self, parent: QModelIndex = ...) -> int:
-        return 4
+        return 9
 
     def add_custom_aggregate(self):
         c = self.rowCount(QModelIndex())
         self.beginInsertRows(QModelIndex(), c, c)
-        self.custom_aggregates.append(CustomAggregate())
-        self.endResetModel()
+        definition = {'title': self.tr('new custom aggregate'), 'aggregate': 'max'}
+        relations = list(relation_index().relations().values())
+        if len(relations) > 0:
+            definition['relation_id'] = relations[0].id()
+            definition['field'] = relations[0].referencingLayer().fields().at(0).name()
+        self.custom_aggregates.append(CustomAggregate(definition))
+        self.endInsertRows()
 
     def remove_custom_aggregate(self, index: QModelIndex):
         if not index.isValid():
@@ -61,10 +74,30 @@ class AggregateModel(QAbstractTableModel):
                 return self.tr('Aggregate')
             if section == Column.FieldColumn.value:
                 return self.tr('Field')
+            if section == Column.OrderFieldColumn.value:
+                return self.tr('Order by')
+            if section == Column.LimitColumn.value:
+                return self.tr('Count')
+            if section == Column.ComparisonColumn.value:
+                return self.tr('Comparison')
+            if section == Column.ThresholdColumn.value:
+                return self.tr('Threshold')
+            if section == Column.ProjectColumn.value:
+                return self.tr('Project')
 
         return None
 
+    def add_custom_aggregates(self, custom_aggregates: [CustomAggregate]):
+        if len(custom_aggregates) == 0:
+            return
+        c = self.rowCount(QModelIndex())
+        self.beginInsertRows(QModelIndex(), c, c + len(custom_aggregates) - 1)
+        self.custom_aggregates.extend(custom_aggregates)
+        self.endInsertRows()
+
     def flags(self, index: QModelIndex) -> Qt.ItemFlags:
+        if index.column() == Column.ProjectColumn.value:
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
         flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
         return flags
 
@@ -81,9 +114,25 @@ class AggregateModel(QAbstractTableModel):
                 return self.custom_aggregates[index.row()].aggregate
             if index.column() == Column.FieldColumn.value:
                 return self.custom_aggregates[index.row()].field
-
-        if role == Qt.EditRole and index.column() == Column.TitleColumn.value:
-            return self.custom_aggregates[index.row()].title
+            if index.column() == Column.OrderFieldColumn.value:
+                return self.custom_aggregates[index.row()].order_field
+            if index.column() == Column.LimitColumn.value:
+                return self.custom_aggregates[index.row()].limit
+            if index.column() == Column.ComparisonColumn.value:
+                return self.custom_aggregates[index.row()].comparison
+            if index.column() == Column.ThresholdColumn.value:
+                return self.custom_aggregates[index.row()].threshold
+
+        if role == Qt.CheckStateRole and index.column() == Column.ProjectColumn.value:
+            return Qt.Checked if self.custom_aggregates[index.row()].project else Qt.Unchecked
+
+        if role == Qt.EditRole:
+            if index.column() == Column.TitleColumn.value:
+                return self.custom_aggregates[index.row()].title
+            if index.column() == Column.LimitColumn.value:
+                return self.custom_aggregates[index.row()].limit
+            if index.column() == Column.ThresholdColumn.value:
+                return self.custom_aggregates[index.row()].threshold
 
         if role == Role.RelationRole.value:
             return self.custom_aggregates[index.row()].relation()
@@ -97,6 +146,12 @@ class AggregateModel(QAbstractTableModel):
         if role == Role.FieldRole.value:
             return self.custom_aggregates[index.row()].field
 
+        if role == Role.OrderFieldRole.value:
+            return self.custom_aggregates[index.row()].order_field
+
+        if role == Role.ComparisonRole.value:
+            return self.custom_aggregates[index.row()].comparison
+
         return None
 
     def setData(self, index: QModelIndex, value, role: int = Qt.EditRole) -> bool:
@@ -119,4 +174,25 @@ class AggregateModel(QAbstractTableModel):
             self.custom_aggregates[index.row()].field = value
             return True
 
+        if index.column() == Column.OrderFieldColumn.value:
+            self.custom_aggregates[index.row()].order_field = value
+            return True
+
+        if index.column() == Column.LimitColumn.value:
+            self.custom_aggregates[index.row()].limit = max(1, int(value))
+            return True
+
+        if index.column() == Column.ComparisonColumn.value:
+            self.custom_aggregates[index.row()].comparison = value
+            return True
+
+        if index.column() == Column.ThresholdColumn.value:
+            self.custom_aggregates[index.row()].threshold = float(value)
+            return True
+
+        if index.column() == Column.ProjectColumn.value and role == Qt.CheckStateRole:
+            self.custom_aggregates[index.row()].project = value == Qt.Checked
+            self.dataChanged.emit(index, index)
+            return True
+
         return False
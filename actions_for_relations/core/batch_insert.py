@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import QgsFeature, QgsFeedback, QgsFieldConstraints, QgsGeometry, QgsVectorLayer, QgsVectorLayerUtils
+
+
+def create_referencing_features(layer: QgsVectorLayer, template: QgsFeature, referencing_indexes: [int],
+                                keys: [tuple], feedback: QgsFeedback = None) -> [QgsFeature]:
+    """
+    Creates a new feature for every key, copying the attributes of the template feature.
+    Primary keys, provider defaults and unique fields are generated for every new feature,
+    as well as fields with a default value expression whose value was not edited in the form.
+    :param layer: the referencing layer
+    :param template: the feature whose attributes are copied
+    :param referencing_indexes: the indexes of the referencing fields
+    :param keys: the keys of the referenced features, written in the referencing fields
+    :param feedback: an optional feedback for progress and cancellation
+    """
+    fields = layer.fields()
+    context = layer.createExpressionContext()
+    generated_indexes = set(layer.primaryKeyAttributes())
+    for index in range(fields.count()):
+        if layer.dataProvider().defaultValueClause(index):
+            generated_indexes.add(index)
+        elif fields.at(index).constraints().constraints() & QgsFieldConstraints.ConstraintUnique:
+            generated_indexes.add(index)
+        elif layer.defaultValueDefinition(index).isValid() and \
+                template.attribute(index) == layer.defaultValue(index, template, context):
+            # the default was kept in the form, it is evaluated again for every feature
+            generated_indexes.add(index)
+    attributes = {index: template.attribute(index)
+                  for index in range(fields.count()) if index not in generated_indexes}
+
+    new_features = []
+    for key in keys:
+        if feedback and len(new_features) % 100 == 0:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * len(new_features) / len(keys))
+        for position, referencing_field_index in enumerate(referencing_indexes):
+            attributes[referencing_field_index] = key[position] if key else None
+        new_features.append(QgsVectorLayerUtils.createFeature(layer, QgsGeometry(), attributes, context))
+    return new_features
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import QgsFeatureRequest, QgsAbstractFeatureSource, QgsFeedback
+from actions_for_relations.core.relation_key import RelationKey
+
+CHUNK_SIZE = 1000
+
+
+def referencing_feature_ids(source: QgsAbstractFeatureSource, relation_key: RelationKey, parent_keys,
+                            feedback: QgsFeedback = None, chunk_size: int = CHUNK_SIZE) -> [int]:
+    """
+    Resolves the ids of the referencing features for the given parent keys.
+    The keys are sent in chunks so the filter can be compiled by the provider.
+    :param source: the feature source of the referencing layer
+    :param relation_key: the key extractor of the relation
+    :param parent_keys: an iterable of referenced keys
+    :param feedback: an optional feedback for progress and cancellation
+    :param chunk_size: the maximum number of keys per request
+    """
+    parent_keys = list(parent_keys)
+    fids = []
+    for start in range(0, len(parent_keys), chunk_size):
+        if feedback:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * start / len(parent_keys))
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(relation_key.referencing_indexes)
+        request.setFilterExpression(relation_key.filter_expression(parent_keys[start:start + chunk_size]))
+        for feature in source.getFeatures(request):
+            fids.append(feature.id())
+    return fids
+
+
+def referenced_feature_ids(source: QgsAbstractFeatureSource, relation_key: RelationKey, child_keys,
+                           feedback: QgsFeedback = None, chunk_size: int = CHUNK_SIZE) -> [int]:
+    """
+    Resolves the ids of the referenced features for the given foreign keys, fetching attributes only
+    :param source: the feature source of the referenced layer
+    :param relation_key: the key extractor of the relation
+    :param child_keys: an iterable of keys as returned by referencing_key
+    :param feedback: an optional feedback for progress and cancellation
+    :param chunk_size: the maximum number of keys per request
+    """
+    child_keys = list(child_keys)
+    fids = []
+    for start in range(0, len(child_keys), chunk_size):
+        if feedback:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * start / len(child_keys))
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(relation_key.referenced_indexes)
+        request.setFilterExpression(relation_key.referenced_filter_expression(child_keys[start:start + chunk_size]))
+        for feature in source.getFeatures(request):
+            fids.append(feature.id())
+    return fids
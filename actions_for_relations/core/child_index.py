@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from collections import OrderedDict
+from qgis.core import QgsAbstractFeatureSource, QgsFeatureRequest, QgsFeedback, QgsRelation
+from actions_for_relations.core.relation_index import relation_index
+from actions_for_relations.core.relation_key import RelationKey
+from actions_for_relations.core.utils import is_null
+
+# rough memory cost of an indexed feature and of each indexed value, in bytes
+FEATURE_COST = 200
+VALUE_COST = 100
+
+
+class ChildIndexData:
+    """
+    Content of a child index: foreign key => child feature ids,
+    field index => {feature id: value} for the aggregated fields,
+    and the min/max per foreign key of these fields.
+    """
+    def __init__(self, field_indexes: [int]):
+        self.fids_by_key = {}
+        self.key_by_fid = {}
+        self.values = {field_index: {} for field_index in field_indexes}
+        # field index => {key: (min, [min fids], max, [max fids])}
+        self.extremes = {field_index: {} for field_index in field_indexes}
+
+    def add(self, fid: int, key: tuple, values: dict):
+        self.key_by_fid[fid] = key
+        if key is not None:
+            self.fids_by_key.setdefault(key, set()).add(fid)
+        for field_index, value in values.items():
+            self.values[field_index][fid] = value
+            if key is not None:
+                self.extremes[field_index].pop(key, None)
+
+    def remove(self, fid: int):
+        key = self.key_by_fid.pop(fid, None)
+        if key is not None:
+            fids = self.fids_by_key.get(key)
+            if fids is not None:
+                fids.discard(fid)
+                if len(fids) == 0:
+                    del self.fids_by_key[key]
+        for field_index, values in self.values.items():
+            values.pop(fid, None)
+            if key is not None:
+                self.extremes[field_index].pop(key, None)
+
+    def compute_extremes(self, field_index: int, key: tuple) -> tuple:
+        minimum, min_fids, maximum, max_fids = None, [], None, []
+        values = self.values[field_index]
+        for fid in self.fids_by_key.get(key, ()):
+            value = values.get(fid)
+            if is_null(value):
+                continue
+            if minimum is None or value < minimum:
+                minimum, min_fids = value, [fid]
+            elif value == minimum:
+                min_fids.append(fid)
+            if maximum is None or value > maximum:
+                maximum, max_fids = value, [fid]
+            elif value == maximum:
+                max_fids.append(fid)
+        extremes = (minimum, min_fids, maximum, max_fids)
+        self.extremes[field_index][key] = extremes
+        return extremes
+
+    def memory_estimate(self) -> int:
+        return len(self.key_by_fid) * (FEATURE_COST + VALUE_COST * len(self.values))
+
+
+def build_child_index_data(source: QgsAbstractFeatureSource, relation_key: RelationKey, field_indexes: [int],
+                           feedback: QgsFeedback = None, feature_count: int = 0) -> ChildIndexData:
+    """
+    Scans the referencing layer once and returns the content of its child index
+    :param source: the feature source of the referencing layer
+    :param relation_key: the key extractor of the relation
+    :param field_indexes: the indexes of the fields used by custom aggregates
+    :param feedback: an optional feedback for progress and cancellation
+    :param feature_count: the number of features of the source, used to report progress
+    """
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(list(set(relation_key.referencing_indexes + field_indexes)))
+
+    data = ChildIndexData(field_indexes)
+    for scanned, feature in enumerate(source.getFeatures(request)):
+        if feedback and scanned % 1000 == 0:
+            if feedback.isCanceled():
+                break
+            if feature_count:
+                feedback.setProgress(100 * scanned / feature_count)
+        data.add(
+            feature.id(),
+            relation_key.referencing_key(feature),
+            {field_index: feature.attribute(field_index) for field_index in field_indexes}
+        )
+    return data
+
+
+class ChildKeyIndex:
+    """
+    Index of the children of a relation, built lazily in a task and kept up to date
+    with the edits of the referencing layer. Must only be used from the GUI thread.
+    """
+    def __init__(self, relation: QgsRelation, field_indexes: [int]):
+        self.relation_id = relation.id()
+        self.layer = relation.referencingLayer()
+        self.relation_key = relation_index().relation_key(relation)
+        self.field_indexes = sorted(set(field_indexes))
+        self.data = None
+        # set if the layer is edited while the index is being built
+        self.stale = False
+        # lookups of other actions waiting for the index being built, None if it is not being built
+        self.pending_lookups = None
+
+        self.layer.featureAdded.connect(self.on_feature_added)
+        self.layer.featureDeleted.connect(self.on_feature_deleted)
+        self.layer.attributeValueChanged.connect(self.on_attribute_value_changed)
+        self.layer.dataChanged.connect(self.invalidate)
+        self.layer.updatedFields.connect(self.invalidate)
+        # added features get new ids once committed, rolled back edits are not notified feature by feature
+        self.layer.afterCommitChanges.connect(self.invalidate)
+        self.layer.afterRollBack.connect(self.invalidate)
+
+    def disconnect(self):
+        self.layer.featureAdded.disconnect(self.on_feature_added)
+        self.layer.featureDeleted.disconnect(self.on_feature_deleted)
+        self.layer.attributeValueChanged.disconnect(self.on_attribute_value_changed)
+        self.layer.dataChanged.disconnect(self.invalidate)
+        self.layer.updatedFields.disconnect(self.invalidate)
+        self.layer.afterCommitChanges.disconnect(self.invalidate)
+        self.layer.afterRollBack.disconnect(self.invalidate)
+
+    def is_built(self) -> bool:
+        return self.data is not None
+
+    def is_building(self) -> bool:
+        return self.pending_lookups is not None
+
+    def start_building(self):
+        self.stale = False
+        self.pending_lookups = []
+
+    def queue_lookup(self, lookup):
+        """
+        Queues a lookup until the index being built is installed
+        :param lookup: a callable, called without argument
+        """
+        self.pending_lookups.append(lookup)
+
+    def install(self, data: ChildIndexData) -> list:
+        """
+        Installs the data built in a task. If the layer was edited meanwhile,
+        the data can be used once and is dropped at the next invalidation check.
+        :return: the lookups queued during the build, to be run before the invalidation check
+        """
+        self.data = data
+        pending_lookups = self.pending_lookups or []
+        self.pending_lookups = None
+        return pending_lookups
+
+    def abort_building(self):
+        """
+        Drops the queued lookups if the build failed or was canceled
+        """
+        self.pending_lookups = None
+
+    def release_if_stale(self):
+        if self.stale:
+            self.data = None
+            self.stale = False
+
+    def invalidate(self):
+        self.data = None
+        self.stale = True
+
+    def _read(self, fid: int):
+        request = QgsFeatureRequest(fid)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(list(set(self.relation_key.referencing_indexes + self.field_indexes)))
+        for feature in self.layer.getFeatures(request):
+            self.data.add(
+                fid,
+                self.relation_key.referencing_key(feature),
+                {field_index: feature.attribute(field_index) for field_index in self.field_indexes}
+            )
+
+    def on_feature_added(self, fid: int):
+        if self.data is None:
+            self.stale = True
+            return
+        self._read(fid)
+
+    def on_feature_deleted(self, fid: int):
+        if self.data is None:
+            self.stale = True
+            return
+        self.data.remove(fid)
+
+    def on_attribute_value_changed(self, fid: int, field_index: int, value):
+        if self.data is None:
+            self.stale = True
+            return
+        if field_index in self.relation_key.referencing_indexes or field_index in self.field_indexes:
+            self.data.remove(fid)
+            self._read(fid)
+
+    def feature_ids(self, parent_keys) -> [int]:
+        """
+        Returns the ids of the children of the given parent keys
+        """
+        fids = []
+        for key in parent_keys:
+            fids.extend(self.data.fids_by_key.get(key, ()))
+        return fids
+
+    def aggregate_feature_ids(self, parent_keys, aggregate: str, field_index: int) -> [int]:
+        """
+        Returns the ids of the children whose value equals the min or max of their parent
+        """
+        if aggregate not in ('min', 'max'):
+            raise ValueError('unsupported aggregate: {}'.format(aggregate))
+        extremes = self.data.extremes[field_index]
+        fids = []
+        for key in parent_keys:
+            if key not in self.data.fids_by_key:
+                continue
+            key_extremes = extremes.get(key) or self.data.compute_extremes(field_index, key)
+            fids.extend(key_extremes[1] if aggregate == 'min' else key_extremes[3])
+        return fids
+
+    def memory_estimate(self) -> int:
+        return self.data.memory_estimate() if self.data else 0
+
+
+class ChildIndexCache:
+    """
+    Least recently used child indexes, evicted above a memory budget
+    """
+    def __init__(self, memory_budget: int):
+        """
+        :param memory_budget: the memory budget in bytes
+        """
+        self.memory_budget = memory_budget
+        self.indexes = OrderedDict()
+
+    def index(self, relation: QgsRelation, field_indexes: [int]) -> ChildKeyIndex:
+        """
+        Returns the index of the relation, created if needed, covering the given fields
+        """
+        index = self.indexes.get(relation.id())
+        if index is not None and not set(field_indexes).issubset(index.field_indexes):
+            field_indexes = list(set(field_indexes) | set(index.field_indexes))
+            self.remove(relation.id())
+            index = None
+        if index is None:
+            index = ChildKeyIndex(relation, field_indexes)
+            self.indexes[relation.id()] = index
+        self.indexes.move_to_end(relation.id())
+        return index
+
+    def remove(self, relation_id: str):
+        index = self.indexes.pop(relation_id, None)
+        if index is not None:
+            index.disconnect()
+
+    def clear(self):
+        for relation_id in list(self.indexes.keys()):
+            self.remove(relation_id)
+
+    def enforce_budget(self):
+        """
+        Evicts the least recently used indexes until the memory budget is met,
+        the most recently used index is always kept.
+        """
+        while len(self.indexes) > 1 and \
+                sum([index.memory_estimate() for index in self.indexes.values()]) > self.memory_budget:
+            self.remove(next(iter(self.indexes)))
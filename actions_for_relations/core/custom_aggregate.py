@@ -8,33 +8,48 @@
 #
 # -----------------------------------------------------------
 
-from qgis.PyQt.QtCore import QObject
-from qgis.core import QgsProject, QgsRelation
+import json
+from qgis.core import Qgis, QgsMessageLog, QgsRelation
+from actions_for_relations.core.aggregate_engine import AGGREGATES, COMPARISONS, NUMERIC_AGGREGATES
+from actions_for_relations.core.instrumentation import LOG_TAG
+from actions_for_relations.core.relation_index import relation_index
+from actions_for_relations.core.settings import Settings
 
 
-class CustomAggregate(QObject):
-    def __init__(self, definition: dict = {}):
-        super(CustomAggregate, self).__init__()
-        if not definition:
-            definition['title'] = self.tr('new custom aggregate')
-            relations = list(QgsProject.instance().relationManager().relations().values())
-            definition['aggregate'] = 'max'
-            if len(relations) > 0:
-                definition['relation_id'] = relations[0].id()
-                definition['field'] = relations[0].referencingLayer().fields().at(0).name()
+class CustomAggregate:
+    """
+    Definition of a custom aggregate. The definition is validated on creation
+    and only resolved against the project relations when used.
+    """
+    __slots__ = ('relation_id', 'title', 'aggregate', 'field', 'order_field', 'limit', 'comparison', 'threshold',
+                 'project')
 
+    def __init__(self, definition: dict = None):
+        """
+        :param definition: the definition as returned by as_dict
+        :raises ValueError: if the definition is not valid
+        """
+        definition = definition or {}
         self.relation_id = definition.get('relation_id')
-        self.title = definition.get('title')
-        self.aggregate = definition.get('aggregate')
+        self.title = definition.get('title', '')
+        self.aggregate = definition.get('aggregate', 'max')
         self.field = definition.get('field')
+        # first/last: the field ordering the children and the number of children kept
+        self.order_field = definition.get('order_field')
+        self.limit = int(definition.get('limit', 1))
+        # count/sum/mean: the comparison of the aggregated value with the threshold
+        self.comparison = definition.get('comparison', '>')
+        self.threshold = float(definition.get('threshold', 0))
+        # saved in the project file rather than in the user settings
+        self.project = bool(definition.get('project', False))
 
-    def relation(self):
-        relation: QgsRelation = None
-        for _relation in QgsProject.instance().relationManager().relations().values():
-            if _relation.id() == self.relation_id:
-                relation = _relation
-                break
-        return relation
+        if self.aggregate not in AGGREGATES:
+            raise ValueError('unsupported aggregate: {}'.format(self.aggregate))
+        if self.comparison not in COMPARISONS:
+            raise ValueError('unsupported comparison: {}'.format(self.comparison))
+
+    def relation(self) -> QgsRelation:
+        return relation_index().relation(self.relation_id)
 
     def relation_name(self):
         relation = self.relation()
@@ -47,7 +62,12 @@ class CustomAggregate(QObject):
         relation = self.relation()
         if relation is None:
             return False
-        if relation.referencedLayer().fields().indexFromName(self.field) < 0:
+        fields = relation.referencingLayer().fields()
+        if fields.indexFromName(self.field) < 0:
+            return False
+        if self.aggregate in NUMERIC_AGGREGATES and not fields.field(self.field).isNumeric():
+            return False
+        if self.order_field and fields.indexFromName(self.order_field) < 0:
             return False
         return True
 
@@ -57,4 +77,71 @@ class CustomAggregate(QObject):
             'title': self.title,
             'aggregate': self.aggregate,
             'field': self.field,
+            'order_field': self.order_field,
+            'limit': self.limit,
+            'comparison': self.comparison,
+            'threshold': self.threshold,
+            'project': self.project,
         }
+
+
+def load_custom_aggregates(definitions: [dict]) -> [CustomAggregate]:
+    """
+    Creates the custom aggregates of the given definitions, invalid ones are logged and skipped
+    """
+    custom_aggregates = []
+    for definition in definitions:
+        try:
+            custom_aggregates.append(CustomAggregate(definition))
+        except (AttributeError, TypeError, ValueError) as e:
+            QgsMessageLog.logMessage(
+                'Skipping invalid custom aggregate {}: {}'.format(definition, e), LOG_TAG, Qgis.Warning
+            )
+    return custom_aggregates
+
+
+def read_custom_aggregates(settings: Settings) -> [CustomAggregate]:
+    """
+    Returns the custom aggregates of the user settings followed by the ones of the current project
+    """
+    definitions = list(settings.value('custom_aggregates'))
+    project_definitions = settings.value('project_custom_aggregates')
+    if project_definitions:
+        try:
+            definitions.extend([dict(definition, project=True) for definition in json.loads(project_definitions)])
+        except (TypeError, ValueError) as e:
+            QgsMessageLog.logMessage(
+                'Skipping invalid custom aggregates of the project: {}'.format(e), LOG_TAG, Qgis.Warning
+            )
+    return load_custom_aggregates(definitions)
+
+
+def write_custom_aggregates(settings: Settings, custom_aggregates: [CustomAggregate]):
+    """
+    Saves the custom aggregates in the user settings or in the project, according to their scope
+    """
+    definitions = [custom_aggregate.as_dict() for custom_aggregate in custom_aggregates]
+    settings.set_value('custom_aggregates', [definition for definition in definitions if not definition['project']])
+    project_definitions = [definition for definition in definitions if definition['project']]
+    if project_definitions or settings.value('project_custom_aggregates'):
+        settings.set_value('project_custom_aggregates', json.dumps(project_definitions))
+
+
+def import_custom_aggregates(path: str) -> [CustomAggregate]:
+    """
+    Reads custom aggregates from a JSON file containing a list of definitions
+    :raises ValueError: if the file is not a list of definitions
+    """
+    with open(path, encoding='utf-8') as f:
+        definitions = json.load(f)
+    if not isinstance(definitions, list):
+        raise ValueError('a list of custom aggregate definitions is expected')
+    return load_custom_aggregates(definitions)
+
+
+def export_custom_aggregates(path: str, custom_aggregates: [CustomAggregate]):
+    """
+    Writes the custom aggregates to a JSON file
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([custom_aggregate.as_dict() for custom_aggregate in custom_aggregates], f, indent=2)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import QgsProcessingFeedback, QgsProcessingMultiStepFeedback, QgsRelation
+from actions_for_relations.core.child_features import referencing_feature_ids
+from actions_for_relations.core.selection import referenced_keys
+
+
+def relation_graph(relations: [QgsRelation], layer_id: str) -> dict:
+    """
+    Returns the relations reachable from a layer, following relations from referenced to referencing layers
+    :param relations: the relations of the project
+    :param layer_id: the id of the root layer
+    :return: referenced layer id => [relations]
+    """
+    relations_by_layer = {}
+    for relation in relations:
+        if relation.isValid():
+            relations_by_layer.setdefault(relation.referencedLayer().id(), []).append(relation)
+
+    graph = {}
+    pending = [layer_id]
+    while pending:
+        current = pending.pop()
+        if current in graph:
+            continue
+        graph[current] = relations_by_layer.get(current, [])
+        pending.extend([relation.referencingLayer().id() for relation in graph[current]])
+    return graph
+
+
+def cycle_relations(graph: dict, layer_id: str) -> [QgsRelation]:
+    """
+    Returns the relations closing a cycle in the graph, i.e. leading back to a layer being traversed
+    :param graph: the graph as returned by relation_graph
+    :param layer_id: the id of the root layer
+    """
+    cycles = []
+    visited = set()
+    # depth first traversal, the stack holds (layer id, iterator over its relations)
+    ancestors = {layer_id}
+    stack = [(layer_id, iter(graph.get(layer_id, [])))]
+    visited.add(layer_id)
+    while stack:
+        current, relations = stack[-1]
+        relation = next(relations, None)
+        if relation is None:
+            stack.pop()
+            ancestors.discard(current)
+            continue
+        child = relation.referencingLayer().id()
+        if child in ancestors:
+            cycles.append(relation)
+        elif child not in visited:
+            visited.add(child)
+            ancestors.add(child)
+            stack.append((child, iter(graph.get(child, []))))
+    return cycles
+
+
+def descendant_feature_ids(sources: dict, relation_keys: dict, graph: dict, layer_id: str, feature_ids: [int],
+                           feedback: QgsProcessingFeedback = None) -> dict:
+    """
+    Walks the relations level by level and returns the descendants of the given features.
+    For each level and relation, the keys of the parents are collected in a set and resolved in batched requests.
+    Features already reached are not followed again, so cycles terminate.
+    :param sources: layer id => feature source of the layers of the graph
+    :param relation_keys: relation id => RelationKey
+    :param graph: the graph as returned by relation_graph
+    :param layer_id: the id of the root layer
+    :param feature_ids: the ids of the features on the root layer
+    :param feedback: an optional feedback for progress and cancellation,
+                     progress assumes each relation is followed once and stalls on cycles
+    :return: layer id => set of descendant feature ids, the root features are not included
+    """
+    # the key collection and the resolution of each relation are steps
+    step_count = max(1, 2 * sum([len(relations) for relations in graph.values()]))
+    step_feedback = QgsProcessingMultiStepFeedback(step_count, feedback) if feedback else None
+    step = 0
+
+    visited = {layer_id: set(feature_ids)}
+    descendants = {}
+    frontier = {layer_id: set(feature_ids)}
+    while frontier:
+        next_frontier = {}
+        for parent_layer_id, fids in frontier.items():
+            for relation in graph.get(parent_layer_id, []):
+                if step_feedback:
+                    if step_feedback.isCanceled():
+                        return descendants
+                    step_feedback.setCurrentStep(min(step, step_count - 1))
+                step += 2
+                relation_key = relation_keys[relation.id()]
+                parent_keys = set(referenced_keys(sources[parent_layer_id], relation_key, fids, step_feedback))
+                parent_keys.discard(None)
+                if len(parent_keys) == 0:
+                    continue
+                if step_feedback:
+                    if step_feedback.isCanceled():
+                        return descendants
+                    step_feedback.setCurrentStep(min(step - 1, step_count - 1))
+                child_layer_id = relation.referencingLayer().id()
+                child_fids = set(referencing_feature_ids(
+                    sources[child_layer_id], relation_key, parent_keys, step_feedback
+                ))
+                child_fids -= visited.setdefault(child_layer_id, set())
+                if len(child_fids) == 0:
+                    continue
+                visited[child_layer_id] |= child_fids
+                descendants.setdefault(child_layer_id, set()).update(child_fids)
+                next_frontier.setdefault(child_layer_id, set()).update(child_fids)
+        frontier = next_frontier
+    return descendants
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (
+    QgsAbstractFeatureSource, QgsCoordinateReferenceSystem, QgsFeature, QgsFeatureRequest, QgsFeedback, QgsField,
+    QgsFields, QgsVectorFileWriter, QgsWkbTypes
+)
+from actions_for_relations.core.child_features import CHUNK_SIZE
+from actions_for_relations.core.relation_key import RelationKey
+
+# driver name => file extension
+EXPORT_FORMATS = {
+    'GPKG': 'gpkg',
+    'CSV': 'csv',
+    'Parquet': 'parquet',
+}
+
+
+def available_export_formats() -> [str]:
+    """
+    Returns the drivers of EXPORT_FORMATS available in the GDAL build of QGIS
+    """
+    drivers = [details.driverName for details in QgsVectorFileWriter.supportedFiltersAndFormats()]
+    return [driver for driver in EXPORT_FORMATS.keys() if driver in drivers]
+
+
+def export_fields(fields: QgsFields, referenced_fields: QgsFields, relation_key: RelationKey,
+                  parent_key_field: str = None) -> QgsFields:
+    """
+    Returns the fields of the exported features, with the parent key field if required.
+    The parent key field has the type of the referenced field, or is a string for composite keys.
+    """
+    fields = QgsFields(fields)
+    if parent_key_field:
+        if relation_key.is_composite():
+            fields.append(QgsField(parent_key_field, QVariant.String))
+        else:
+            referenced_field = referenced_fields.at(relation_key.referenced_indexes[0])
+            fields.append(QgsField(parent_key_field, referenced_field.type(), referenced_field.typeName()))
+    return fields
+
+
+def export_referencing_features(source: QgsAbstractFeatureSource, fields: QgsFields, wkb_type: QgsWkbTypes.Type,
+                                crs: QgsCoordinateReferenceSystem, relation_key: RelationKey, parent_keys,
+                                path: str, driver: str, add_parent_key: bool = False, feedback: QgsFeedback = None,
+                                chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Streams the referencing features of the given parent keys to a file. Features are requested by chunks of keys
+    and written by chunks of features, so only one chunk of features is held in memory.
+    :param source: the feature source of the referencing layer
+    :param fields: the fields of the exported features, as returned by export_fields
+    :param wkb_type: the geometry type of the referencing layer
+    :param crs: the CRS of the referencing layer
+    :param relation_key: the key extractor of the relation
+    :param parent_keys: an iterable of referenced keys
+    :param path: the path of the file
+    :param driver: the OGR driver name
+    :param add_parent_key: if True, the last field of fields is filled with the key of the parent
+    :param feedback: an optional feedback for progress and cancellation
+    :param chunk_size: the maximum number of keys per request and of features per write
+    :return: the number of exported features
+    :raises IOError: if the file cannot be written
+    """
+    writer = QgsVectorFileWriter(path, 'UTF-8', fields, wkb_type, crs, driver)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise IOError(writer.errorMessage())
+
+    parent_keys = list(parent_keys)
+    count = 0
+    features = []
+
+    def write():
+        if not writer.addFeatures(features):
+            raise IOError(writer.errorMessage())
+        features.clear()
+
+    try:
+        for start in range(0, len(parent_keys), chunk_size):
+            if feedback:
+                if feedback.isCanceled():
+                    break
+                feedback.setProgress(100 * start / len(parent_keys))
+            request = QgsFeatureRequest()
+            request.setFilterExpression(relation_key.filter_expression(parent_keys[start:start + chunk_size]))
+            for feature in source.getFeatures(request):
+                if add_parent_key:
+                    key = relation_key.referencing_key(feature)
+                    if key is not None:
+                        key = key[0] if not relation_key.is_composite() else ', '.join([str(value) for value in key])
+                    exported = QgsFeature(fields, feature.id())
+                    exported.setGeometry(feature.geometry())
+                    exported.setAttributes(feature.attributes() + [key])
+                    features.append(exported)
+                else:
+                    features.append(feature)
+                count += 1
+                if len(features) >= chunk_size:
+                    write()
+        write()
+    finally:
+        # flushes and closes the file
+        del writer
+    return count
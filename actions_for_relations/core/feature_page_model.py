@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.PyQt.QtCore import Qt, QObject, QAbstractTableModel, QModelIndex
+from qgis.core import QgsApplication, QgsAttributeTableConfig, QgsFeatureRequest, QgsVectorLayer
+from actions_for_relations.core.utils import is_null
+
+PAGE_SIZE = 200
+
+
+def displayed_field_indexes(layer: QgsVectorLayer) -> [int]:
+    """
+    Returns the indexes of the fields shown in the attribute table of the layer, in their configured order
+    """
+    fields = layer.fields()
+    field_indexes = []
+    for column in layer.attributeTableConfig().columns():
+        if column.hidden or column.type != QgsAttributeTableConfig.Field:
+            continue
+        field_index = fields.indexFromName(column.name)
+        if field_index >= 0:
+            field_indexes.append(field_index)
+    if len(field_indexes) == 0:
+        field_indexes = list(range(fields.count()))
+    return field_indexes
+
+
+class FeaturePageModel(QAbstractTableModel):
+    """
+    Table of the features of a layer given by their ids.
+    Features are fetched by pages of feature ids when the view scrolls,
+    without geometry and only for the displayed fields.
+    """
+    def __init__(self, parent: QObject = None, page_size: int = PAGE_SIZE):
+        super(FeaturePageModel, self).__init__(parent)
+        self.page_size = page_size
+        self.layer = None
+        self.fids = []
+        self.field_indexes = []
+        # number of feature ids already requested
+        self.fetched = 0
+        # loaded rows: (feature id, [values])
+        self.rows = []
+
+    def set_features(self, layer: QgsVectorLayer, fids: [int]):
+        self.beginResetModel()
+        self.layer = layer
+        self.fids = list(fids)
+        self.field_indexes = displayed_field_indexes(layer) if layer else []
+        self.fetched = 0
+        self.rows = []
+        self.endResetModel()
+
+    def clear(self):
+        self.set_features(None, [])
+
+    def feature_count(self) -> int:
+        return len(self.fids)
+
+    def feature_id(self, row: int) -> int:
+        return self.rows[row][0]
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.field_indexes)
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        if parent.isValid() or self.layer is None:
+            return False
+        return self.fetched < len(self.fids)
+
+    def fetchMore(self, parent: QModelIndex):
+        if not self.canFetchMore(parent):
+            return
+        batch = self.fids[self.fetched:self.fetched + self.page_size]
+        self.fetched += len(batch)
+
+        request = QgsFeatureRequest()
+        request.setFilterFids(batch)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(self.field_indexes)
+        request.setLimit(len(batch))
+        values = {}
+        for feature in self.layer.getFeatures(request):
+            values[feature.id()] = [feature.attribute(field_index) for field_index in self.field_indexes]
+
+        # keep the order of the ids, features deleted meanwhile are skipped
+        rows = [(fid, values[fid]) for fid in batch if fid in values]
+        if len(rows) == 0:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            if 0 <= section < len(self.field_indexes):
+                return self.layer.fields().at(self.field_indexes[section]).displayName()
+        elif 0 <= section < len(self.rows):
+            return self.rows[section][0]
+        return None
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        if role in (Qt.DisplayRole, Qt.ToolTipRole):
+            value = self.rows[index.row()][1][index.column()]
+            if is_null(value):
+                return QgsApplication.nullRepresentation()
+            return value
+        return None
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import QgsExpression
+
+
+def key_filter_expression(field: str, values) -> str:
+    """
+    Returns an expression matching the features whose field value is one of the given values
+    :param field: the field name
+    :param values: an iterable of values
+    """
+    values = list(values)
+    if len(values) == 0:
+        return 'FALSE'
+    return '{field} IN ({values})'.format(
+        field=QgsExpression.quotedColumnRef(field),
+        values=', '.join([QgsExpression.quotedValue(value) for value in values])
+    )
+
+
+def fid_filter_expression(fids) -> str:
+    """
+    Returns an expression matching the given feature ids
+    :param fids: an iterable of feature ids
+    """
+    fids = sorted(fids)
+    if len(fids) == 0:
+        return 'FALSE'
+    return '$id IN ({fids})'.format(fids=', '.join([str(fid) for fid in fids]))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+import time
+from contextlib import contextmanager
+from qgis.core import Qgis, QgsMessageLog
+
+LOG_TAG = 'Actions for relations'
+
+
+class Instrumentation:
+    """
+    Per-phase timers and counters of an action, written to the message log when enabled.
+    Phases and counters can be recorded from a task thread, the log is written once at the end.
+    """
+    def __init__(self, action: str, enabled: bool = False):
+        self.action = action
+        self.enabled = enabled
+        self.timings = []
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Times the enclosed block
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def count(self, name: str, value: int = 1):
+        """
+        Increments a counter
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def message(self) -> str:
+        timings = ', '.join(['{}: {:.3f}s'.format(name, seconds) for name, seconds in self.timings])
+        counters = ', '.join(['{}: {}'.format(name, value) for name, value in self.counters.items()])
+        total = sum([seconds for _, seconds in self.timings])
+        return '{action} ({total:.3f}s) | {timings} | {counters}'.format(
+            action=self.action, total=total, timings=timings, counters=counters
+        )
+
+    def log(self):
+        if self.enabled:
+            QgsMessageLog.logMessage(self.message(), LOG_TAG, Qgis.Info)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import QgsAbstractFeatureSource, QgsFeatureRequest, QgsFeedback
+from actions_for_relations.core.relation_key import RelationKey
+from actions_for_relations.core.utils import is_null
+
+
+def check_integrity(referenced_source: QgsAbstractFeatureSource, referencing_source: QgsAbstractFeatureSource,
+                    relation_key: RelationKey, feedback: QgsFeedback = None, referenced_count: int = 0,
+                    referencing_count: int = 0) -> ([int], [int]):
+    """
+    Finds the orphan children and the childless parents of a relation in linear time:
+    the keys of the referenced layer are loaded in a hash map, then the referencing layer is streamed against it.
+    Children with a NULL foreign key are not orphans.
+    :param referenced_source: the feature source of the referenced layer
+    :param referencing_source: the feature source of the referencing layer
+    :param relation_key: the key extractor of the relation
+    :param feedback: an optional feedback for progress and cancellation
+    :param referenced_count: the number of features of the referenced layer, used to report progress
+    :param referencing_count: the number of features of the referencing layer, used to report progress
+    :return: the ids of the orphan referencing features and of the childless referenced features
+    """
+    total = referenced_count + referencing_count
+
+    def report(scanned: int) -> bool:
+        if feedback is None:
+            return True
+        if feedback.isCanceled():
+            return False
+        if total:
+            feedback.setProgress(100 * scanned / total)
+        return True
+
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(relation_key.referenced_indexes)
+    # key => [parent ids], keys might not be unique
+    parents = {}
+    for scanned, feature in enumerate(referenced_source.getFeatures(request)):
+        if scanned % 1000 == 0 and not report(scanned):
+            return [], []
+        key = relation_key.referenced_key(feature)
+        if key is not None:
+            parents.setdefault(key, []).append(feature.id())
+
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(relation_key.referencing_indexes)
+    orphans = []
+    referenced_keys = set()
+    for scanned, feature in enumerate(referencing_source.getFeatures(request)):
+        if scanned % 1000 == 0 and not report(referenced_count + scanned):
+            return [], []
+        key = relation_key.referencing_key(feature)
+        if key is None:
+            if not any([is_null(feature.attribute(index)) for index in relation_key.referencing_indexes]):
+                # the foreign key cannot be converted to the type of the referenced key
+                orphans.append(feature.id())
+            continue
+        if key in parents:
+            referenced_keys.add(key)
+        else:
+            orphans.append(feature.id())
+
+    childless = []
+    for key, fids in parents.items():
+        if key not in referenced_keys:
+            childless.extend(fids)
+    return orphans, childless
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import QgsProject, QgsRelation
+from actions_for_relations.core.relation_key import RelationKey
+
+
+class RelationIndex:
+    """
+    Index of the project relations by id and of their keys,
+    invalidated whenever the relation manager changes.
+    """
+    def __init__(self):
+        self._relations = None
+        # relation id => RelationKey
+        self._keys = {}
+        QgsProject.instance().relationManager().changed.connect(self.invalidate)
+
+    def invalidate(self):
+        self._relations = None
+        self._keys = {}
+
+    def relations(self) -> dict:
+        """
+        Returns the project relations as a dictionary relation id => relation
+        """
+        if self._relations is None:
+            self._relations = dict(QgsProject.instance().relationManager().relations())
+        return self._relations
+
+    def relation(self, relation_id: str) -> QgsRelation:
+        """
+        Returns the relation for the given id or None if it does not exist
+        """
+        return self.relations().get(relation_id)
+
+    def relation_key(self, relation: QgsRelation) -> RelationKey:
+        """
+        Returns the key of the relation, created again if its field pairs or the fields of its layers changed
+        """
+        key = self._keys.get(relation.id())
+        if key is None or not key.is_up_to_date(relation):
+            key = self._keys[relation.id()] = RelationKey(relation)
+        return key
+
+
+_relation_index = None
+
+
+def relation_index() -> RelationIndex:
+    """
+    Returns the relation index shared across the plugin
+    """
+    global _relation_index
+    if _relation_index is None:
+        _relation_index = RelationIndex()
+    return _relation_index
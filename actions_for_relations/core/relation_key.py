@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import QgsExpression, QgsFeature, QgsFields, QgsRelation
+from actions_for_relations.core.utils import is_null
+
+
+def _to_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _quote_number(value) -> str:
+    if type(value) is int:
+        return str(value)
+    return QgsExpression.quotedValue(value)
+
+
+class RelationKey:
+    """
+    Extracts the keys of a relation, possibly made of several field pairs.
+    Field indexes, type handling and filter quoting are resolved once, keys are tuples of values.
+    """
+    def __init__(self, relation: QgsRelation):
+        referencing_layer_fields = relation.referencingLayer().fields()
+        referenced_layer_fields = relation.referencedLayer().fields()
+        # kept to detect changes of the relation and of the fields of the layers
+        self.field_pairs = dict(relation.fieldPairs())
+        self.fields = (QgsFields(referencing_layer_fields), QgsFields(referenced_layer_fields))
+
+        self.referencing_fields = []
+        self.referenced_fields = []
+        self.referencing_indexes = []
+        self.referenced_indexes = []
+        # position in the key => conversion of the referencing value to the type of the referenced one
+        self._converters = {}
+        # position in the key => quoted fields and quoting function of the values
+        self._quoted_referencing_fields = []
+        self._quoted_referenced_fields = []
+        self._quoters = []
+
+        for position, (referencing, referenced) in enumerate(relation.fieldPairs().items()):
+            self.referencing_fields.append(referencing)
+            self.referenced_fields.append(referenced)
+            self.referencing_indexes.append(referencing_layer_fields.indexFromName(referencing))
+            self.referenced_indexes.append(referenced_layer_fields.indexFromName(referenced))
+            referenced_numeric = referenced_layer_fields.field(referenced).isNumeric()
+            if referencing_layer_fields.field(referencing).isNumeric() != referenced_numeric:
+                self._converters[position] = _to_number if referenced_numeric else str
+            self._quoted_referencing_fields.append(QgsExpression.quotedColumnRef(referencing))
+            self._quoted_referenced_fields.append(QgsExpression.quotedColumnRef(referenced))
+            self._quoters.append(_quote_number if referenced_numeric else QgsExpression.quotedValue)
+
+        self._condition_templates = {
+            True: self._condition_template(self._quoted_referencing_fields),
+            False: self._condition_template(self._quoted_referenced_fields),
+        }
+
+    @staticmethod
+    def _condition_template(quoted_fields: [str]) -> str:
+        return '({})'.format(' AND '.join([
+            '{} = {{}}'.format(field.replace('{', '{{').replace('}', '}}')) for field in quoted_fields
+        ]))
+
+    def is_up_to_date(self, relation: QgsRelation) -> bool:
+        """
+        Returns if the field pairs of the relation and the fields of its layers are unchanged since the key was created
+        """
+        return self.field_pairs == relation.fieldPairs() and \
+            self.fields[0] == relation.referencingLayer().fields() and \
+            self.fields[1] == relation.referencedLayer().fields()
+
+    def is_composite(self) -> bool:
+        return len(self.referencing_fields) > 1
+
+    def has_conversions(self) -> bool:
+        """
+        Returns if referencing values have to be converted to be compared to referenced ones
+        """
+        return len(self._converters) > 0
+
+    def referenced_key(self, feature: QgsFeature) -> tuple:
+        """
+        Returns the key of a feature of the referenced layer, None if any of its values is NULL
+        """
+        key = tuple([feature.attribute(index) for index in self.referenced_indexes])
+        for value in key:
+            if is_null(value):
+                return None
+        return key
+
+    def referencing_key(self, feature: QgsFeature) -> tuple:
+        """
+        Returns the key of a feature of the referencing layer, None if any of its values is NULL.
+        Values are converted to the type of the referenced fields, so they can be compared to referenced keys.
+        """
+        key = [feature.attribute(index) for index in self.referencing_indexes]
+        for value in key:
+            if is_null(value):
+                return None
+        for position, converter in self._converters.items():
+            try:
+                key[position] = converter(key[position])
+            except ValueError:
+                return None
+        return tuple(key)
+
+    def filter_expression(self, keys) -> str:
+        """
+        Returns an expression matching the features of the referencing layer for the given keys
+        :param keys: an iterable of keys as returned by referenced_key
+        """
+        return self._filter_expression(True, keys)
+
+    def referenced_filter_expression(self, keys) -> str:
+        """
+        Returns an expression matching the features of the referenced layer for the given keys
+        :param keys: an iterable of keys as returned by referencing_key
+        """
+        return self._filter_expression(False, keys)
+
+    def _filter_expression(self, referencing: bool, keys) -> str:
+        keys = list(keys)
+        if len(keys) == 0:
+            return 'FALSE'
+        if not self.is_composite():
+            quote = self._quoters[0]
+            field = self._quoted_referencing_fields[0] if referencing else self._quoted_referenced_fields[0]
+            return '{field} IN ({values})'.format(
+                field=field, values=', '.join([quote(key[0]) for key in keys])
+            )
+        template = self._condition_templates[referencing]
+        return ' OR '.join([
+            template.format(*[quote(value) for quote, value in zip(self._quoters, key)]) for key in keys
+        ])
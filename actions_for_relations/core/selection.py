@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.PyQt.QtCore import Qt
+from qgis.core import QgsFeatureRequest, QgsAbstractFeatureSource, QgsFeedback, QgsVectorLayer
+from actions_for_relations.core.relation_key import RelationKey
+
+
+def referenced_keys(source: QgsAbstractFeatureSource, relation_key: RelationKey, feature_ids: [int],
+                    feedback: QgsFeedback = None) -> [tuple]:
+    """
+    Streams the given features of the referenced layer and returns their keys,
+    fetching only the referenced fields and no geometry.
+    :param source: the feature source of the referenced layer
+    :param relation_key: the key extractor of the relation
+    :param feature_ids: the ids of the features on the referenced layer
+    :param feedback: an optional feedback for progress and cancellation
+    """
+    return referenced_keys_by_relation(source, [relation_key], feature_ids, feedback)[0]
+
+
+def referenced_keys_by_relation(source: QgsAbstractFeatureSource, relation_keys: [RelationKey], feature_ids: [int],
+                                feedback: QgsFeedback = None) -> [[tuple]]:
+    """
+    Returns the keys of the given features for several relations sharing the referenced layer,
+    reading the features once.
+    :param source: the feature source of the referenced layer
+    :param relation_keys: the key extractors of the relations
+    :param feature_ids: the ids of the features on the referenced layer
+    :param feedback: an optional feedback for progress and cancellation
+    :return: the list of keys for each relation key
+    """
+    indexes = set()
+    for relation_key in relation_keys:
+        indexes.update(relation_key.referenced_indexes)
+
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(sorted(indexes))
+    request.setFilterFids(list(feature_ids))
+
+    keys = [[] for _ in relation_keys]
+    for count, feature in enumerate(source.getFeatures(request)):
+        if feedback and count % 1000 == 0:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * count / len(feature_ids))
+        for position, relation_key in enumerate(relation_keys):
+            keys[position].append(relation_key.referenced_key(feature))
+    return keys
+
+
+def referencing_keys(source: QgsAbstractFeatureSource, relation_key: RelationKey, feature_ids: [int],
+                     feedback: QgsFeedback = None) -> set:
+    """
+    Returns the distinct foreign keys of the given features of the referencing layer,
+    converted to the types of the referenced fields, without NULL keys.
+    :param source: the feature source of the referencing layer
+    :param relation_key: the key extractor of the relation
+    :param feature_ids: the ids of the features on the referencing layer
+    :param feedback: an optional feedback for progress and cancellation
+    """
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(relation_key.referencing_indexes)
+    request.setFilterFids(list(feature_ids))
+
+    keys = set()
+    for count, feature in enumerate(source.getFeatures(request)):
+        if feedback and count % 1000 == 0:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * count / len(feature_ids))
+        keys.add(relation_key.referencing_key(feature))
+    keys.discard(None)
+    return keys
+
+
+def selection_behavior(modifiers: Qt.KeyboardModifiers) -> QgsVectorLayer.SelectBehavior:
+    """
+    Returns the selection behavior for the keyboard modifiers, as for the selection tools of QGIS:
+    Shift adds to the selection, Ctrl removes from it, Ctrl+Shift intersects it, no modifier replaces it.
+    """
+    shift = bool(modifiers & Qt.ShiftModifier)
+    control = bool(modifiers & Qt.ControlModifier)
+    if shift and control:
+        return QgsVectorLayer.IntersectSelection
+    if shift:
+        return QgsVectorLayer.AddToSelection
+    if control:
+        return QgsVectorLayer.RemoveFromSelection
+    return QgsVectorLayer.SetSelection
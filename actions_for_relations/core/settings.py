@@ -9,7 +9,7 @@
 # -----------------------------------------------------------
 
 
-from actions_for_relations.setting_manager import SettingManager, Scope, List
+from actions_for_relations.setting_manager import SettingManager, Scope, List, Integer, Bool, String
 
 pluginName = "actions_for_relations"
 
@@ -17,4 +17,18 @@ pluginName = "actions_for_relations"
 class Settings(SettingManager):
     def __init__(self):
         SettingManager.__init__(self, pluginName)
-        self.add_setting(List('custom_aggregates', Scope.Global, []))
\ No newline at end of file
+        self.add_setting(List('custom_aggregates', Scope.Global, []))
+        # custom aggregates saved in the project file, as JSON
+        self.add_setting(String('project_custom_aggregates', Scope.Project, ''))
+        # above this number of selected features, children are resolved to feature ids and shown in the results dock
+        self.add_setting(Integer('fid_filter_threshold', Scope.Global, 1000))
+        # compute aggregates in the database for database backed layers
+        self.add_setting(Bool('sql_pushdown', Scope.Global, True))
+        # log timings and counters of the actions in the message log
+        self.add_setting(Bool('instrumentation', Scope.Global, False))
+        # keep an in-memory index of the referencing features of the relations
+        self.add_setting(Bool('child_index', Scope.Global, False))
+        # memory budget of the child indexes, in MiB
+        self.add_setting(Integer('child_index_memory_budget', Scope.Global, 200))
+        # show referencing features in a paged dock rather than in the attribute table
+        self.add_setting(Bool('results_dock', Scope.Global, False))
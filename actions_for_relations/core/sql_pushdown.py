@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.core import (
+    QgsAbstractFeatureSource, QgsDataSourceUri, QgsExpression, QgsFeatureRequest,
+    QgsFeedback, QgsProviderRegistry, QgsVectorLayer
+)
+try:
+    from qgis.core import QgsProviderConnectionException
+except ImportError:
+    # QGIS < 3.10, the pushdown is never used
+    QgsProviderConnectionException = Exception
+from actions_for_relations.core.filters import key_filter_expression
+from actions_for_relations.core.relation_key import RelationKey
+
+CHUNK_SIZE = 1000
+
+
+class AggregatePushdown:
+    """
+    Computes a grouped aggregate in the database of the referencing layer,
+    with one GROUP BY query per chunk of parent keys.
+    Supports PostgreSQL/PostGIS, SpatiaLite and GeoPackage layers on single-field relations.
+    """
+    def __init__(self, provider: str, connection_uri: str, table: str, subset: str,
+                 fk: str, pk: str, pk_index: int, pk_is_fid: bool):
+        self.provider = provider
+        self.connection_uri = connection_uri
+        self.table = table
+        self.subset = subset
+        self.fk = fk
+        self.pk = pk
+        self.pk_index = pk_index
+        self.pk_is_fid = pk_is_fid
+
+    @staticmethod
+    def from_layer(layer: QgsVectorLayer, relation_key: RelationKey):
+        """
+        Returns the pushdown for the given referencing layer, or None if it cannot be used.
+        Parent keys are bound as literals, so only the referencing layer has to be database backed.
+        The database does not see the pending edits of the layer, so it is not used while the layer is modified.
+        Must be called from the GUI thread.
+        """
+        if layer.isEditable() and layer.isModified():
+            return None
+        if relation_key.is_composite() or relation_key.has_conversions():
+            return None
+        pk_indexes = layer.dataProvider().pkAttributeIndexes()
+        if len(pk_indexes) != 1:
+            return None
+        pk = layer.fields().at(pk_indexes[0]).name()
+        provider = layer.providerType()
+        subset = layer.subsetString()
+        pk_is_fid = False
+
+        metadata = QgsProviderRegistry.instance().providerMetadata(provider) \
+            if hasattr(QgsProviderRegistry.instance(), 'providerMetadata') else None
+        if metadata is None or not hasattr(metadata, 'createConnection'):
+            # database connections API is not available (QGIS < 3.10)
+            return None
+
+        if provider in ('postgres', 'spatialite'):
+            uri = QgsDataSourceUri(layer.source())
+            if not uri.table() or uri.table().startswith('('):
+                # custom queries are not supported
+                return None
+            if provider == 'postgres':
+                table = '{}.{}'.format(QgsExpression.quotedColumnRef(uri.schema() or 'public'),
+                                       QgsExpression.quotedColumnRef(uri.table()))
+                uri.setSql('')
+                connection_uri = uri.uri(False)
+            else:
+                table = QgsExpression.quotedColumnRef(uri.table())
+                connection_uri = uri.database()
+        elif provider == 'ogr':
+            parts = QgsProviderRegistry.instance().decodeUri(provider, layer.source())
+            path = parts.get('path', '')
+            if not path.lower().endswith('.gpkg') or not parts.get('layerName'):
+                return None
+            if subset.strip().upper().startswith('SELECT'):
+                return None
+            table = QgsExpression.quotedColumnRef(parts['layerName'])
+            connection_uri = path
+            # the first field of GeoPackage layers exposed by OGR is the feature id
+            pk_is_fid = pk_indexes[0] == 0
+        else:
+            return None
+
+        return AggregatePushdown(
+            provider, connection_uri, table, subset, relation_key.referencing_fields[0], pk, pk_indexes[0], pk_is_fid
+        )
+
+    def sql(self, parent_keys: [tuple], aggregate: str, field: str) -> str:
+        """
+        Returns the query selecting the primary keys of the features matching the aggregate
+        """
+        if aggregate not in ('min', 'max'):
+            raise ValueError('unsupported aggregate: {}'.format(aggregate))
+        subset = ' AND ({})'.format(self.subset) if self.subset else ''
+        outer_subset = ' WHERE ({})'.format(self.subset) if self.subset else ''
+        return 'SELECT c.{pk} FROM {table} c ' \
+               'JOIN (SELECT {fk} AS k, {aggregate}({field}) AS v FROM {table} ' \
+               'WHERE {fk} IN ({keys}){subset} GROUP BY {fk}) g ' \
+               'ON c.{fk} = g.k AND c.{field} = g.v{outer_subset}'.format(
+                pk=QgsExpression.quotedColumnRef(self.pk),
+                table=self.table,
+                fk=QgsExpression.quotedColumnRef(self.fk),
+                aggregate=aggregate,
+                field=QgsExpression.quotedColumnRef(field),
+                keys=', '.join([QgsExpression.quotedValue(key[0]) for key in parent_keys]),
+                subset=subset,
+                outer_subset=outer_subset
+               )
+
+    def feature_ids(self, source: QgsAbstractFeatureSource, parent_keys, aggregate: str, field: str,
+                    feedback: QgsFeedback = None) -> [int]:
+        """
+        Runs the grouped queries and returns the ids of the matching referencing features.
+        Raises QgsProviderConnectionException on database errors.
+        :param source: the feature source of the referencing layer, used to resolve primary keys to feature ids
+        """
+        connection = QgsProviderRegistry.instance().providerMetadata(self.provider).createConnection(
+            self.connection_uri, {}
+        )
+        parent_keys = list(parent_keys)
+        pks = []
+        for start in range(0, len(parent_keys), CHUNK_SIZE):
+            if feedback:
+                if feedback.isCanceled():
+                    return []
+                feedback.setProgress(50 * start / len(parent_keys))
+            rows = connection.executeSql(self.sql(parent_keys[start:start + CHUNK_SIZE], aggregate, field))
+            pks.extend([row[0] for row in rows])
+
+        if self.pk_is_fid:
+            return pks
+
+        fids = []
+        for start in range(0, len(pks), CHUNK_SIZE):
+            if feedback:
+                if feedback.isCanceled():
+                    return []
+                feedback.setProgress(50 + 50 * start / len(pks))
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes([self.pk_index])
+            request.setFilterExpression(key_filter_expression(self.pk, pks[start:start + CHUNK_SIZE]))
+            for feature in source.getFeatures(request):
+                fids.append(feature.id())
+        return fids
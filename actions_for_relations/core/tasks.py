@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (
+    QgsTask, QgsRelation, QgsVectorLayer, QgsVectorLayerFeatureSource,
+    QgsProcessingFeedback, QgsProcessingMultiStepFeedback, QgsFeedback
+)
+from actions_for_relations.core.aggregate_engine import (
+    AggregateSpec, EXTREMUM_AGGREGATES, grouped_aggregate_feature_ids
+)
+from actions_for_relations.core.child_features import referencing_feature_ids, referenced_feature_ids
+from actions_for_relations.core.child_index import build_child_index_data
+from actions_for_relations.core.custom_aggregate import CustomAggregate
+from actions_for_relations.core.descendants import relation_graph, cycle_relations, descendant_feature_ids
+from actions_for_relations.core.export import export_fields, export_referencing_features
+from actions_for_relations.core.filters import fid_filter_expression
+from actions_for_relations.core.instrumentation import Instrumentation
+from actions_for_relations.core.integrity import check_integrity
+from actions_for_relations.core.relation_index import relation_index
+from actions_for_relations.core.selection import referenced_keys, referenced_keys_by_relation, referencing_keys
+from actions_for_relations.core.sql_pushdown import AggregatePushdown, QgsProviderConnectionException
+
+
+class ReferencedKeysTask(QgsTask):
+    """
+    Collects the keys of the given features of the referenced layer.
+    Subclasses process the collected keys in the same task.
+    Layers are only accessed through feature sources, created in the GUI thread.
+    """
+    steps = 1
+
+    def __init__(self, description: str, relation: QgsRelation, feature_ids: [int],
+                 instrumentation: Instrumentation = None):
+        super(ReferencedKeysTask, self).__init__(description, QgsTask.CanCancel)
+        self.instrumentation = instrumentation or Instrumentation(description)
+        self.relation = relation
+        self.relation_key = relation_index().relation_key(relation)
+        self.feature_ids = list(feature_ids)
+        self.referenced_source = QgsVectorLayerFeatureSource(relation.referencedLayer())
+        self.keys = []
+        self.exception = None
+        self.feedback = QgsProcessingFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+    def cancel(self):
+        self.feedback.cancel()
+        super(ReferencedKeysTask, self).cancel()
+
+    def run(self) -> bool:
+        try:
+            feedback = QgsProcessingMultiStepFeedback(self.steps, self.feedback)
+            with self.instrumentation.phase('key collection'):
+                self.keys = referenced_keys(self.referenced_source, self.relation_key, self.feature_ids, feedback)
+            self.instrumentation.count('referenced features', len(self.keys))
+            if feedback.isCanceled():
+                return False
+            if self.steps > 1:
+                feedback.setCurrentStep(1)
+                self.process(feedback)
+            return not feedback.isCanceled()
+        except Exception as e:
+            self.exception = e
+            return False
+
+    def parent_keys(self) -> set:
+        """
+        Returns the distinct collected keys, without NULL keys
+        """
+        parent_keys = set(self.keys)
+        parent_keys.discard(None)
+        return parent_keys
+
+    def process(self, feedback: QgsFeedback):
+        pass
+
+
+class RelationsKeysTask(ReferencedKeysTask):
+    """
+    Collects the keys of the given features for several relations sharing the referenced layer,
+    reading the referenced features once.
+    """
+    def __init__(self, description: str, relations: [QgsRelation], feature_ids: [int],
+                 instrumentation: Instrumentation = None):
+        super(RelationsKeysTask, self).__init__(description, relations[0], feature_ids, instrumentation)
+        self.relations = relations
+        self.relation_keys = [relation_index().relation_key(relation) for relation in relations]
+        # relation id => keys
+        self.keys_by_relation = {}
+
+    def run(self) -> bool:
+        try:
+            with self.instrumentation.phase('key collection'):
+                keys = referenced_keys_by_relation(
+                    self.referenced_source, self.relation_keys, self.feature_ids, self.feedback
+                )
+            self.keys_by_relation = {relation.id(): keys for relation, keys in zip(self.relations, keys)}
+            self.keys = keys[0]
+            self.instrumentation.count('referenced features', len(self.keys))
+            return not self.feedback.isCanceled()
+        except Exception as e:
+            self.exception = e
+            return False
+
+
+class ReferencingFeaturesTask(ReferencedKeysTask):
+    """
+    Computes the filter expression of the referencing features.
+    Above the threshold, the referencing features are only resolved to feature ids, without expression.
+    """
+    steps = 2
+
+    def __init__(self, relation: QgsRelation, feature_ids: [int], fid_filter_threshold: int,
+                 instrumentation: Instrumentation = None, fids_only: bool = False):
+        """
+        :param fids_only: always resolve the feature ids, whatever the threshold
+        """
+        super(ReferencingFeaturesTask, self).__init__(
+            QCoreApplication.translate('ReferencingFeaturesTask', 'Resolving referencing features in "{layer}"')
+                .format(layer=relation.referencingLayer().name()),
+            relation, feature_ids, instrumentation
+        )
+        self.fid_filter_threshold = fid_filter_threshold
+        self.fids_only = fids_only
+        self.referencing_source = QgsVectorLayerFeatureSource(relation.referencingLayer())
+        # the filter expression, only below the threshold
+        self.expression = None
+        # the referencing feature ids, only above the threshold
+        self.fids = None
+
+    def process(self, feedback: QgsFeedback):
+        parent_keys = self.parent_keys()
+        self.instrumentation.count('parent keys', len(parent_keys))
+        if len(parent_keys) <= self.fid_filter_threshold and not self.fids_only:
+            with self.instrumentation.phase('expression'):
+                self.expression = self.relation_key.filter_expression(parent_keys)
+            self.instrumentation.count('expression length', len(self.expression))
+        else:
+            # resolve the children once, they are paged in the results dock or selected
+            # rather than having the attribute table evaluate a huge expression
+            with self.instrumentation.phase('feature id resolution'):
+                self.fids = referencing_feature_ids(self.referencing_source, self.relation_key, parent_keys, feedback)
+            self.instrumentation.count('referencing features', len(self.fids))
+
+
+class AggregateTask(ReferencedKeysTask):
+    """
+    Computes the referencing features matching a custom aggregate
+    """
+    steps = 2
+
+    def __init__(self, relation: QgsRelation, feature_ids: [int], custom_aggregate: CustomAggregate,
+                 sql_pushdown: bool = True, instrumentation: Instrumentation = None):
+        super(AggregateTask, self).__init__(
+            QCoreApplication.translate('AggregateTask', 'Computing aggregate in "{layer}"')
+                .format(layer=relation.referencingLayer().name()),
+            relation, feature_ids, instrumentation
+        )
+        fields = relation.referencingLayer().fields()
+        self.aggregate = custom_aggregate.aggregate
+        self.field = custom_aggregate.field
+        self.spec = AggregateSpec(
+            custom_aggregate.aggregate,
+            fields.indexFromName(custom_aggregate.field),
+            fields.indexFromName(custom_aggregate.order_field) if custom_aggregate.order_field else -1,
+            custom_aggregate.limit,
+            custom_aggregate.comparison,
+            custom_aggregate.threshold
+        )
+        self.feature_count = relation.referencingLayer().featureCount()
+        self.referencing_source = QgsVectorLayerFeatureSource(relation.referencingLayer())
+        self.pushdown = AggregatePushdown.from_layer(relation.referencingLayer(), self.relation_key) \
+            if sql_pushdown and self.aggregate in EXTREMUM_AGGREGATES else None
+        self.expression = None
+        self.fids = None
+
+    def process(self, feedback: QgsFeedback):
+        parent_keys = self.parent_keys()
+        self.instrumentation.count('parent keys', len(parent_keys))
+        fids = None
+        if self.pushdown:
+            try:
+                with self.instrumentation.phase('provider fetch'):
+                    fids = self.pushdown.feature_ids(
+                        self.referencing_source, parent_keys, self.aggregate, self.field, feedback
+                    )
+            except QgsProviderConnectionException:
+                # fall back on the in-process engine
+                self.instrumentation.count('pushdown failures')
+        if fids is None:
+            with self.instrumentation.phase('aggregate computation'):
+                fids = grouped_aggregate_feature_ids(
+                    self.referencing_source, self.relation_key, parent_keys, self.spec, feedback, self.feature_count
+                )
+            self.instrumentation.count('features scanned', self.feature_count)
+        self.fids = fids
+        self.expression = fid_filter_expression(fids)
+        self.instrumentation.count('referencing features', len(fids))
+        self.instrumentation.count('expression length', len(self.expression))
+
+
+class ExportTask(ReferencedKeysTask):
+    """
+    Streams the referencing features of the given features to a file
+    """
+    steps = 2
+
+    def __init__(self, relation: QgsRelation, feature_ids: [int], path: str, driver: str,
+                 parent_key_field: str = None, instrumentation: Instrumentation = None):
+        """
+        :param path: the path of the file
+        :param driver: the OGR driver name
+        :param parent_key_field: if given, the name of a field added with the key of the parent
+        """
+        super(ExportTask, self).__init__(
+            QCoreApplication.translate('ExportTask', 'Exporting referencing features of "{layer}"')
+                .format(layer=relation.referencingLayer().name()),
+            relation, feature_ids, instrumentation
+        )
+        layer = relation.referencingLayer()
+        self.path = path
+        self.driver = driver
+        self.add_parent_key = bool(parent_key_field)
+        self.fields = export_fields(
+            layer.fields(), relation.referencedLayer().fields(), self.relation_key, parent_key_field
+        )
+        self.wkb_type = layer.wkbType()
+        self.crs = layer.crs()
+        self.referencing_source = QgsVectorLayerFeatureSource(layer)
+        self.count = 0
+
+    def process(self, feedback: QgsFeedback):
+        parent_keys = self.parent_keys()
+        self.instrumentation.count('parent keys', len(parent_keys))
+        with self.instrumentation.phase('export'):
+            self.count = export_referencing_features(
+                self.referencing_source, self.fields, self.wkb_type, self.crs, self.relation_key, parent_keys,
+                self.path, self.driver, self.add_parent_key, feedback
+            )
+        self.instrumentation.count('features written', self.count)
+
+
+class ChildIndexTask(ReferencedKeysTask):
+    """
+    Builds the content of a child index in the same pass as the key collection
+    """
+    steps = 2
+
+    def __init__(self, relation: QgsRelation, feature_ids: [int], field_indexes: [int],
+                 instrumentation: Instrumentation = None):
+        super(ChildIndexTask, self).__init__(
+            QCoreApplication.translate('ChildIndexTask', 'Indexing referencing features in "{layer}"')
+                .format(layer=relation.referencingLayer().name()),
+            relation, feature_ids, instrumentation
+        )
+        self.field_indexes = field_indexes
+        self.feature_count = relation.referencingLayer().featureCount()
+        self.referencing_source = QgsVectorLayerFeatureSource(relation.referencingLayer())
+        self.index_data = None
+
+    def process(self, feedback: QgsFeedback):
+        with self.instrumentation.phase('index build'):
+            self.index_data = build_child_index_data(
+                self.referencing_source, self.relation_key, self.field_indexes, feedback, self.feature_count
+            )
+        self.instrumentation.count('features scanned', self.feature_count)
+
+
+class DescendantsTask(QgsTask):
+    """
+    Finds the descendants of features through all the relations reachable from their layer
+    """
+    def __init__(self, layer: QgsVectorLayer, feature_ids: [int], instrumentation: Instrumentation = None):
+        description = QCoreApplication.translate('DescendantsTask', 'Finding descendants of "{layer}"') \
+            .format(layer=layer.name())
+        super(DescendantsTask, self).__init__(description, QgsTask.CanCancel)
+        self.instrumentation = instrumentation or Instrumentation(description)
+        self.layer_id = layer.id()
+        self.feature_ids = list(feature_ids)
+        self.graph = relation_graph(relation_index().relations().values(), self.layer_id)
+        # relations leading back to a layer of the path, they are followed until no new feature is found
+        self.cycles = cycle_relations(self.graph, self.layer_id)
+        self.relation_keys = {}
+        self.sources = {}
+        for relations in self.graph.values():
+            for relation in relations:
+                self.relation_keys[relation.id()] = relation_index().relation_key(relation)
+                for graph_layer in (relation.referencedLayer(), relation.referencingLayer()):
+                    if graph_layer.id() not in self.sources:
+                        self.sources[graph_layer.id()] = QgsVectorLayerFeatureSource(graph_layer)
+        # layer id => descendant feature ids
+        self.descendants = {}
+        self.exception = None
+        self.feedback = QgsProcessingFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+    def cancel(self):
+        self.feedback.cancel()
+        super(DescendantsTask, self).cancel()
+
+    def run(self) -> bool:
+        try:
+            with self.instrumentation.phase('traversal'):
+                self.descendants = descendant_feature_ids(
+                    self.sources, self.relation_keys, self.graph, self.layer_id, self.feature_ids, self.feedback
+                )
+            self.instrumentation.count('layers', len(self.descendants))
+            self.instrumentation.count('descendants', sum([len(fids) for fids in self.descendants.values()]))
+            return not self.feedback.isCanceled()
+        except Exception as e:
+            self.exception = e
+            return False
+
+
+class ReferencedFeaturesTask(QgsTask):
+    """
+    Resolves the referenced (parent) features of the given features of the referencing layer.
+    Distinct foreign keys are collected first, so each parent is fetched once.
+    """
+    def __init__(self, relation: QgsRelation, feature_ids: [int], instrumentation: Instrumentation = None):
+        description = QCoreApplication.translate('ReferencedFeaturesTask', 'Resolving referenced features in "{layer}"') \
+            .format(layer=relation.referencedLayer().name())
+        super(ReferencedFeaturesTask, self).__init__(description, QgsTask.CanCancel)
+        self.instrumentation = instrumentation or Instrumentation(description)
+        self.relation = relation
+        self.relation_key = relation_index().relation_key(relation)
+        self.feature_ids = list(feature_ids)
+        self.referencing_source = QgsVectorLayerFeatureSource(relation.referencingLayer())
+        self.referenced_source = QgsVectorLayerFeatureSource(relation.referencedLayer())
+        self.fids = []
+        self.exception = None
+        self.feedback = QgsProcessingFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+    def cancel(self):
+        self.feedback.cancel()
+        super(ReferencedFeaturesTask, self).cancel()
+
+    def run(self) -> bool:
+        try:
+            feedback = QgsProcessingMultiStepFeedback(2, self.feedback)
+            with self.instrumentation.phase('key collection'):
+                keys = referencing_keys(self.referencing_source, self.relation_key, self.feature_ids, feedback)
+            self.instrumentation.count('distinct keys', len(keys))
+            if feedback.isCanceled():
+                return False
+            feedback.setCurrentStep(1)
+            with self.instrumentation.phase('feature id resolution'):
+                self.fids = referenced_feature_ids(self.referenced_source, self.relation_key, keys, feedback)
+            self.instrumentation.count('referenced features', len(self.fids))
+            return not feedback.isCanceled()
+        except Exception as e:
+            self.exception = e
+            return False
+
+
+class IntegrityTask(QgsTask):
+    """
+    Finds the orphan referencing features and the childless referenced features of a relation
+    """
+    def __init__(self, relation: QgsRelation, instrumentation: Instrumentation = None):
+        description = QCoreApplication.translate('IntegrityTask', 'Checking the integrity of relation "{relation}"') \
+            .format(relation=relation.name())
+        super(IntegrityTask, self).__init__(description, QgsTask.CanCancel)
+        self.instrumentation = instrumentation or Instrumentation(description)
+        self.relation = relation
+        self.relation_key = relation_index().relation_key(relation)
+        self.referenced_source = QgsVectorLayerFeatureSource(relation.referencedLayer())
+        self.referencing_source = QgsVectorLayerFeatureSource(relation.referencingLayer())
+        self.referenced_count = max(0, relation.referencedLayer().featureCount())
+        self.referencing_count = max(0, relation.referencingLayer().featureCount())
+        self.orphans = []
+        self.childless = []
+        self.exception = None
+        self.feedback = QgsFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+    def cancel(self):
+        self.feedback.cancel()
+        super(IntegrityTask, self).cancel()
+
+    def run(self) -> bool:
+        try:
+            with self.instrumentation.phase('integrity check'):
+                self.orphans, self.childless = check_integrity(
+                    self.referenced_source, self.referencing_source, self.relation_key, self.feedback,
+                    self.referenced_count, self.referencing_count
+                )
+            self.instrumentation.count('features scanned', self.referenced_count + self.referencing_count)
+            self.instrumentation.count('orphans', len(self.orphans))
+            self.instrumentation.count('childless', len(self.childless))
+            return not self.feedback.isCanceled()
+        except Exception as e:
+            self.exception = e
+            return False
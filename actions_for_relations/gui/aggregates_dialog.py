@@ -11,12 +11,17 @@
 
 import os
 from qgis.PyQt.QtCore import QObject, QModelIndex, pyqtSlot
-from qgis.PyQt.QtWidgets import QDialog, QStyledItemDelegate, QComboBox, QAbstractItemView, QHeaderView
+from qgis.PyQt.QtWidgets import (
+    QDialog, QStyledItemDelegate, QComboBox, QAbstractItemView, QHeaderView, QFileDialog, QMessageBox
+)
 from qgis.PyQt.uic import loadUiType
-from qgis.core import QgsProject
 from qgis.gui import QgsFieldComboBox
-from actions_for_relations.core.custom_aggregate import CustomAggregate
+from actions_for_relations.core.aggregate_engine import AGGREGATES, COMPARISONS
+from actions_for_relations.core.custom_aggregate import (
+    CustomAggregate, write_custom_aggregates, import_custom_aggregates, export_custom_aggregates
+)
 from actions_for_relations.core.aggregate_model import AggregateModel, Role, Column
+from actions_for_relations.core.relation_index import relation_index
 from actions_for_relations.core.settings import Settings
 
 
@@ -29,7 +34,7 @@ class RelationEditorDelegate(QStyledItemDelegate):
 
     def createEditor(self, parent, option, index):
         cb = QComboBox(parent)
-        for relation in QgsProject.instance().relationManager().relations().values():
+        for relation in relation_index().relations().values():
             cb.addItem(relation.name(), relation.id())
         return cb
 
@@ -51,7 +56,7 @@ class AggregateEditorDelegate(QStyledItemDelegate):
 
     def createEditor(self, parent, option, index):
         cb = QComboBox(parent)
-        for agg in ('min', 'max'):
+        for agg in AGGREGATES:
             cb.addItem(agg, agg)
         return cb
 
@@ -67,20 +72,44 @@ class AggregateEditorDelegate(QStyledItemDelegate):
         editor.setGeometry(option.rect)
 
 
-class FieldEditorDelegate(QStyledItemDelegate):
+class ComparisonEditorDelegate(QStyledItemDelegate):
     def __init__(self, parent: QObject = None):
+        super(ComparisonEditorDelegate, self).__init__(parent)
+
+    def createEditor(self, parent, option, index):
+        cb = QComboBox(parent)
+        for comparison in COMPARISONS.keys():
+            cb.addItem(comparison, comparison)
+        return cb
+
+    def setEditorData(self, editor, index):
+        comparison = index.model().data(index, Role.ComparisonRole.value)
+        editor.setCurrentIndex(editor.findData(comparison))
+
+    def setModelData(self, editor, model, index):
+        comparison = editor.currentData()
+        model.setData(index, comparison)
+
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(option.rect)
+
+
+class FieldEditorDelegate(QStyledItemDelegate):
+    def __init__(self, parent: QObject = None, role: Role = Role.FieldRole, allow_empty: bool = False):
         super(FieldEditorDelegate, self).__init__(parent)
+        self.role = role
+        self.allow_empty = allow_empty
 
     def createEditor(self, parent, option, index: QModelIndex):
         fc = QgsFieldComboBox(parent)
+        fc.setAllowEmptyFieldName(self.allow_empty)
         relation = index.model().data(index, Role.RelationRole.value)
-        print('hey', relation, index.column())
         if relation:
             fc.setLayer(relation.referencingLayer())
         return fc
 
     def setEditorData(self, editor, index: QModelIndex):
-        field = index.model().data(index, Role.FieldRole.value)
+        field = index.model().data(index, self.role.value)
         editor.setField(field)
 
     def setModelData(self, editor, model, index: QModelIndex):
@@ -103,6 +132,12 @@ class AggregatesDialog(QDialog, DialogUi):
         self.aggregate_table_view.setItemDelegateForColumn(Column.RelationColumn.value, RelationEditorDelegate(self))
         self.aggregate_table_view.setItemDelegateForColumn(Column.AggregateColumn.value, AggregateEditorDelegate(self))
         self.aggregate_table_view.setItemDelegateForColumn(Column.FieldColumn.value, FieldEditorDelegate(self))
+        self.aggregate_table_view.setItemDelegateForColumn(
+            Column.OrderFieldColumn.value, FieldEditorDelegate(self, Role.OrderFieldRole, allow_empty=True)
+        )
+        self.aggregate_table_view.setItemDelegateForColumn(
+            Column.ComparisonColumn.value, ComparisonEditorDelegate(self)
+        )
         self.aggregate_table_view.verticalHeader().hide()
         self.aggregate_table_view.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
         self.aggregate_table_view.horizontalHeader().setStretchLastSection(True)
@@ -113,13 +148,34 @@ class AggregatesDialog(QDialog, DialogUi):
         self.accepted.connect(self.save_custom_aggregates)
         self.add_tool_button.clicked.connect(self.aggregate_model.add_custom_aggregate)
         self.remove_tool_button.clicked.connect(self.remove_custom_aggregate)
+        self.import_tool_button.clicked.connect(self.import_custom_aggregates)
+        self.export_tool_button.clicked.connect(self.export_custom_aggregates)
         self.aggregate_table_view.selectionModel().currentRowChanged.connect(self.on_selection_changed)
 
     def save_custom_aggregates(self):
-        definitions = []
-        for custom_aggregate in self.aggregate_model.custom_aggregates:
-            definitions.append(custom_aggregate.as_dict())
-        self.settings.set_value('custom_aggregates', definitions)
+        write_custom_aggregates(self.settings, self.aggregate_model.custom_aggregates)
+
+    @pyqtSlot()
+    def import_custom_aggregates(self):
+        path, _ = QFileDialog.getOpenFileName(self, self.tr('Import custom aggregates'), '', 'JSON (*.json)')
+        if not path:
+            return
+        try:
+            custom_aggregates = import_custom_aggregates(path)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, self.tr('Import custom aggregates'), str(e))
+            return
+        self.aggregate_model.add_custom_aggregates(custom_aggregates)
+
+    @pyqtSlot()
+    def export_custom_aggregates(self):
+        path, _ = QFileDialog.getSaveFileName(self, self.tr('Export custom aggregates'), '', 'JSON (*.json)')
+        if not path:
+            return
+        try:
+            export_custom_aggregates(path, self.aggregate_model.custom_aggregates)
+        except OSError as e:
+            QMessageBox.warning(self, self.tr('Export custom aggregates'), str(e))
 
     @pyqtSlot()
     def remove_custom_aggregate(self):
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+import os
+from qgis.PyQt.QtCore import pyqtSlot
+from qgis.PyQt.QtWidgets import QDialog, QDialogButtonBox
+from qgis.PyQt.uic import loadUiType
+from qgis.gui import QgsFileWidget
+from actions_for_relations.core.export import EXPORT_FORMATS, available_export_formats
+
+
+DialogUi, _ = loadUiType(os.path.join(os.path.dirname(__file__), '../ui/export_dialog.ui'))
+
+
+class ExportDialog(QDialog, DialogUi):
+    def __init__(self, parent=None):
+        QDialog.__init__(self, parent)
+        self.setupUi(self)
+
+        for driver in available_export_formats():
+            self.format_combo_box.addItem(driver, driver)
+        self.file_widget.setStorageMode(QgsFileWidget.SaveFile)
+
+        self.format_combo_box.currentIndexChanged.connect(self.on_format_changed)
+        self.file_widget.fileChanged.connect(self.update_ok_button)
+        self.on_format_changed()
+
+    def driver(self) -> str:
+        return self.format_combo_box.currentData()
+
+    def path(self) -> str:
+        path = self.file_widget.filePath()
+        extension = '.' + EXPORT_FORMATS[self.driver()]
+        if path and not path.lower().endswith(extension):
+            path += extension
+        return path
+
+    def parent_key_field(self) -> str:
+        if self.parent_key_check_box.isChecked():
+            return self.parent_key_line_edit.text().strip() or None
+        return None
+
+    @pyqtSlot()
+    def on_format_changed(self):
+        driver = self.driver()
+        if driver:
+            self.file_widget.setFilter('{driver} (*.{extension})'.format(driver=driver, extension=EXPORT_FORMATS[driver]))
+        self.update_ok_button()
+
+    @pyqtSlot()
+    def update_ok_button(self):
+        self.buttonBox.button(QDialogButtonBox.Ok).setEnabled(bool(self.driver() and self.file_widget.filePath()))
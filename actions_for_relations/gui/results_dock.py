@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+import os
+from qgis.PyQt.QtCore import QModelIndex, pyqtSlot
+from qgis.PyQt.QtWidgets import QAbstractItemView
+from qgis.PyQt.uic import loadUiType
+from qgis.core import QgsFeatureRequest, QgsVectorLayer
+from qgis.gui import QgisInterface, QgsDockWidget
+from actions_for_relations.core.feature_page_model import FeaturePageModel
+from actions_for_relations.core.filters import fid_filter_expression
+
+
+DockUi, _ = loadUiType(os.path.join(os.path.dirname(__file__), '../ui/results_dock.ui'))
+
+
+class ResultsDock(QgsDockWidget, DockUi):
+    """
+    Shows referencing features without loading the whole layer in an attribute table
+    """
+    def __init__(self, iface: QgisInterface, parent=None):
+        QgsDockWidget.__init__(self, parent)
+        self.setupUi(self)
+        self.iface = iface
+        self.layer = None
+
+        self.model = FeaturePageModel(self)
+        self.features_table_view.setModel(self.model)
+        self.features_table_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.features_table_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+        self.features_table_view.doubleClicked.connect(self.open_feature_form)
+        self.select_tool_button.clicked.connect(self.select_features)
+        self.attribute_table_tool_button.clicked.connect(self.open_attribute_table)
+
+    def show_features(self, layer: QgsVectorLayer, fids: [int]):
+        if self.layer is not None:
+            self.layer.willBeDeleted.disconnect(self.clear)
+        self.layer = layer
+        self.layer.willBeDeleted.connect(self.clear)
+        self.model.set_features(layer, fids)
+        self.setWindowTitle(self.tr('Referencing features in "{layer}"').format(layer=layer.name()))
+        self.count_label.setText(self.tr('{count} features').format(count=self.model.feature_count()))
+        self.show()
+        self.raise_()
+
+    @pyqtSlot()
+    def clear(self):
+        if self.layer is not None:
+            self.layer.willBeDeleted.disconnect(self.clear)
+        self.layer = None
+        self.model.clear()
+        self.count_label.setText('')
+
+    @pyqtSlot(QModelIndex)
+    def open_feature_form(self, index: QModelIndex):
+        feature = next(self.layer.getFeatures(QgsFeatureRequest(self.model.feature_id(index.row()))), None)
+        if feature is not None:
+            self.iface.openFeatureForm(self.layer, feature)
+
+    @pyqtSlot()
+    def select_features(self):
+        if self.layer is not None:
+            self.layer.selectByIds(self.model.fids)
+
+    @pyqtSlot()
+    def open_attribute_table(self):
+        if self.layer is not None:
+            self.iface.showAttributeTable(self.layer, fid_filter_expression(self.model.fids))
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------
+#
+# QGIS Actions for relations
+# Copyright (C) 2020 Denis Rouzaud
+#
+# licensed under the terms of GNU GPL 2+
+#
+# -----------------------------------------------------------
+
+"""
+Headless benchmarks of the relation actions.
+
+Parent/child layers are generated in memory and in GeoPackage files at several scales,
+each action is timed and its peak memory recorded. Results are written as JSON
+so they can be compared across commits:
+
+    python3 benchmarks/run_benchmarks.py --output before.json
+    python3 benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from qgis.testing import start_app  # noqa: E402
+
+QGIS_APP = start_app()
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal  # noqa: E402
+from qgis.PyQt.QtWidgets import QMainWindow  # noqa: E402
+from qgis.core import (  # noqa: E402
+    Qgis, QgsCoordinateTransformContext, QgsFeature, QgsFeatureRequest, QgsProject, QgsRelation,
+    QgsVectorFileWriter, QgsVectorLayer, QgsVectorLayerFeatureSource
+)
+from actions_for_relations.core.aggregate_engine import AggregateSpec, grouped_aggregate_feature_ids  # noqa: E402
+from actions_for_relations.core.batch_insert import create_referencing_features  # noqa: E402
+from actions_for_relations.core.custom_aggregate import CustomAggregate  # noqa: E402
+from actions_for_relations.core.relation_key import RelationKey  # noqa: E402
+from actions_for_relations.core.tasks import (  # noqa: E402
+    ReferencedKeysTask, ReferencingFeaturesTask, AggregateTask, IntegrityTask
+)
+
+CHILDREN_PER_PARENT = 10
+DEFAULT_SCALES = [1000, 10000, 100000, 1000000]
+DEFAULT_SELECTIONS = [100, 1000, 10000, 100000]
+DEFAULT_RELATION_COUNTS = [10, 100, 500]
+
+
+class BenchmarkInterface(QObject):
+    """
+    Minimal QgisInterface needed to load the plugin without GUI
+    """
+    newProjectCreated = pyqtSignal()
+
+    def __init__(self):
+        super(BenchmarkInterface, self).__init__()
+        self.main_window = QMainWindow()
+
+    def mainWindow(self):
+        return self.main_window
+
+    def addCustomActionForLayerType(self, *args):
+        pass
+
+    def addCustomActionForLayer(self, *args):
+        pass
+
+    def removeCustomActionForLayerType(self, *args):
+        pass
+
+
+def read_status_kb(field: str) -> int:
+    """
+    Returns a memory field of /proc/self/status in kB, None if not available (only on Linux)
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of the process, so the peak of a single run can be read (Linux only)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def measure(function, repeat: int, setup=None) -> dict:
+    """
+    Returns the best time of the function, then its memory peaks measured in a separate run,
+    since tracing Python allocations slows the function down.
+    The resident set size covers the C++ allocations (features, providers), it is measured for this run only
+    and given as the growth over the resident set size before the run.
+    :param setup: called before every run, outside of the measures
+    """
+    seconds = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    if setup:
+        setup()
+    rss_before = read_status_kb('VmRSS')
+    peak_rss = None
+    if reset_peak_rss():
+        function()
+        peak_rss = read_status_kb('VmHWM')
+    if setup:
+        setup()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'peak_python_bytes': peak,
+        'peak_rss_growth_kb': peak_rss - rss_before if peak_rss is not None and rss_before is not None else None,
+    }
+
+
+def memory_layers(child_count: int) -> (QgsVectorLayer, QgsVectorLayer):
+    parent_count = max(1, child_count // CHILDREN_PER_PARENT)
+    parents = QgsVectorLayer('None?field=id:integer&field=name:string', 'parents', 'memory')
+    children = QgsVectorLayer(
+        'None?field=id:integer&field=parent_id:integer&field=value:double', 'children', 'memory'
+    )
+
+    features = []
+    for i in range(parent_count):
+        feature = QgsFeature(parents.fields())
+        feature.setAttributes([i, 'parent {}'.format(i)])
+        features.append(feature)
+    parents.dataProvider().addFeatures(features)
+
+    batch = []
+    for i in range(child_count):
+        feature = QgsFeature(children.fields())
+        feature.setAttributes([i, i % parent_count, float((i * 7919) % 1000)])
+        batch.append(feature)
+        if len(batch) == 10000:
+            children.dataProvider().addFeatures(batch)
+            batch = []
+    children.dataProvider().addFeatures(batch)
+    return parents, children
+
+
+def geopackage_layers(child_count: int, directory: str) -> (QgsVectorLayer, QgsVectorLayer):
+    path = os.path.join(directory, 'benchmark_{}.gpkg'.format(child_count))
+    layers = []
+    for index, layer in enumerate(memory_layers(child_count)):
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        options.layerName = layer.name()
+        if index > 0:
+            options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+        QgsVectorFileWriter.writeAsVectorFormatV2(layer, path, QgsCoordinateTransformContext(), options)
+        layers.append(QgsVectorLayer('{}|layername={}'.format(path, layer.name()), layer.name(), 'ogr'))
+    return layers[0], layers[1]
+
+
+def add_relation(parents: QgsVectorLayer, children: QgsVectorLayer, relation_id: str) -> QgsRelation:
+    relation = QgsRelation()
+    relation.setId(relation_id)
+    relation.setName(relation_id)
+    relation.setReferencedLayer(parents.id())
+    relation.setReferencingLayer(children.id())
+    relation.addFieldPair('parent_id', 'id')
+    assert relation.isValid(), 'invalid relation {}'.format(relation_id)
+    QgsProject.instance().relationManager().addRelation(relation)
+    return relation
+
+
+def run_task(task):
+    assert task.run(), task.exception
+    return task
+
+
+def check_results(children: QgsVectorLayer, relation: QgsRelation, feature_ids: [int],
+                  custom_aggregate: CustomAggregate, pushdown: bool):
+    """
+    Checks that the different paths of an action return the same features before timing them
+    """
+    expression = run_task(ReferencingFeaturesTask(relation, feature_ids, len(feature_ids))).expression
+    request = QgsFeatureRequest()
+    request.setFilterExpression(expression)
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setNoAttributes()
+    expected = set([feature.id() for feature in children.getFeatures(request)])
+    fids = set(run_task(ReferencingFeaturesTask(relation, feature_ids, 0)).fids)
+    assert fids == expected, 'feature ids and key filter differ: {} != {}'.format(len(fids), len(expected))
+
+    task = AggregateTask(relation, feature_ids, custom_aggregate, True)
+    if pushdown and task.pushdown is not None:
+        engine_fids = sorted(run_task(AggregateTask(relation, feature_ids, custom_aggregate, False)).fids)
+        pushdown_fids = sorted(run_task(task).fids)
+        assert pushdown_fids == engine_fids, \
+            'pushdown and engine differ: {} != {}'.format(len(pushdown_fids), len(engine_fids))
+
+
+def action_benchmarks(provider: str, child_count: int, selections: [int], repeat: int, directory: str) -> [dict]:
+    QgsProject.instance().clear()
+    if provider == 'memory':
+        parents, children = memory_layers(child_count)
+    else:
+        parents, children = geopackage_layers(child_count, directory)
+    QgsProject.instance().addMapLayers([parents, children])
+    relation = add_relation(parents, children, 'benchmark_relation')
+
+    results = []
+    for selected_count in selections:
+        if selected_count > parents.featureCount():
+            continue
+        parents.selectByIds(list(range(1, selected_count + 1)))
+        feature_ids = list(parents.selectedFeatureIds())
+        scenario = {'provider': provider, 'children': child_count, 'selected': len(feature_ids)}
+
+        maximum = CustomAggregate({'relation_id': relation.id(), 'title': 'max', 'aggregate': 'max', 'field': 'value'})
+        last = CustomAggregate({'relation_id': relation.id(), 'title': 'last 3', 'aggregate': 'last', 'field': 'value',
+                                'order_field': 'id', 'limit': 3})
+        benchmarks = {
+            'collect_keys': lambda: run_task(ReferencedKeysTask('keys', relation, feature_ids)),
+            'show_children': lambda: run_task(ReferencingFeaturesTask(relation, feature_ids, 1000)),
+            'show_children_fids': lambda: run_task(ReferencingFeaturesTask(relation, feature_ids, 0)),
+            'run_aggregate': lambda: run_task(AggregateTask(relation, feature_ids, maximum, False)),
+            'run_aggregate_last': lambda: run_task(AggregateTask(relation, feature_ids, last, False)),
+        }
+        if provider != 'memory':
+            benchmarks['run_aggregate_pushdown'] = \
+                lambda: run_task(AggregateTask(relation, feature_ids, maximum, True))
+
+        keys = run_task(ReferencedKeysTask('keys', relation, feature_ids)).keys
+        template = next(children.getFeatures())
+
+        def batch_insert():
+            children.startEditing()
+            children.beginEditCommand('benchmark')
+            features = create_referencing_features(children, template, [children.fields().indexFromName('parent_id')], keys)
+            assert len(features) == len(keys), 'created {} features for {} keys'.format(len(features), len(keys))
+            assert children.addFeatures(features), 'features could not be added'
+            children.endEditCommand()
+            children.rollBack()
+        benchmarks['batch_insert'] = batch_insert
+
+        check_results(children, relation, feature_ids, maximum, provider != 'memory')
+
+        for name, function in benchmarks.items():
+            result = dict(scenario, benchmark=name)
+            result.update(measure(function, repeat))
+            results.append(result)
+            print_result(result)
+
+    # raw engine scan, independent from the selection
+    source = QgsVectorLayerFeatureSource(children)
+    all_keys = set([(i,) for i in range(parents.featureCount())])
+    result = {'provider': provider, 'children': child_count, 'selected': len(all_keys), 'benchmark': 'aggregate_scan'}
+    relation_key = RelationKey(relation)
+    result.update(measure(lambda: grouped_aggregate_feature_ids(
+        source, relation_key, all_keys, AggregateSpec('max', children.fields().indexFromName('value'))
+    ), repeat))
+    results.append(result)
+    print_result(result)
+
+    result = {'provider': provider, 'children': child_count, 'selected': 0, 'benchmark': 'integrity_check'}
+    result.update(measure(lambda: run_task(IntegrityTask(relation)), repeat))
+    results.append(result)
+    print_result(result)
+    return results
+
+
+def load_relations_benchmarks(relation_counts: [int], repeat: int) -> [dict]:
+    from actions_for_relations.actions_for_relations_plugin import ActionsForRelationsPlugin
+
+    results = []
+    for relation_count in relation_counts:
+        QgsProject.instance().clear()
+        for i in range(relation_count):
+            parents, children = memory_layers(10)
+            parents.setName('parents_{}'.format(i))
+            children.setName('children_{}'.format(i))
+            QgsProject.instance().addMapLayers([parents, children])
+            add_relation(parents, children, 'relation_{}'.format(i))
+
+        iface = BenchmarkInterface()
+        plugins = []
+
+        def start_plugin():
+            plugins.append(ActionsForRelationsPlugin(iface))
+
+        scenario = {'provider': 'memory', 'children': 10 * relation_count, 'selected': 0, 'relations': relation_count}
+        result = dict(scenario, benchmark='plugin_start')
+        result.update(measure(start_plugin, repeat))
+        results.append(result)
+        print_result(result)
+
+        # the relations are synchronized incrementally, their actions are removed so they are all created again
+        plugin = plugins[-1]
+        result = dict(scenario, benchmark='load_relations')
+        result.update(measure(plugin.load_relations, repeat, plugin.unload_relations))
+        results.append(result)
+        print_result(result)
+
+        for plugin in plugins:
+            plugin.unload()
+    return results
+
+
+def print_result(result: dict):
+    rss = result['peak_rss_growth_kb']
+    print('{benchmark:>24} {provider:>7} children={children:<8} selected={selected:<7} '
+          '{seconds:9.4f}s python={peak:8.1f}MiB rss={rss}'.format(
+            peak=result['peak_python_bytes'] / 2 ** 20,
+            rss='{:8.1f}MiB'.format(rss / 2 ** 10) if rss is not None else 'n/a',
+            **result
+          ))
+
+
+def compare(results: [dict], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def key(result):
+        return (result['benchmark'], result['provider'], result['children'], result['selected'],
+                result.get('relations'))
+
+    baseline_results = {key(result): result for result in baseline['results']}
+    print('\nComparison with {} ({})'.format(baseline_path, baseline['metadata'].get('commit')))
+    for result in results:
+        reference = baseline_results.get(key(result))
+        if reference is None or not reference['seconds']:
+            continue
+        print('{:>24} {:>7} children={:<8} selected={:<7} {:6.2f}x time {:6.2f}x python memory'.format(
+            result['benchmark'], result['provider'], result['children'], result['selected'],
+            result['seconds'] / reference['seconds'],
+            result['peak_python_bytes'] / max(1, reference['peak_python_bytes'])
+        ))
+
+
+def metadata() -> dict:
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'qgis_version': Qgis.QGIS_VERSION,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def int_list(value: str) -> [int]:
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int_list, default=DEFAULT_SCALES, help='numbers of children features')
+    parser.add_argument('--selections', type=int_list, default=DEFAULT_SELECTIONS, help='numbers of selected parents')
+    parser.add_argument('--relations', type=int_list, default=DEFAULT_RELATION_COUNTS,
+                        help='numbers of relations in the project for the start-up benchmarks')
+    parser.add_argument('--providers', default='memory,gpkg', help='memory and/or gpkg')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best time is kept')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for provider in args.providers.split(','):
+            for child_count in args.scales:
+                results.extend(action_benchmarks(provider, child_count, args.selections, args.repeat, directory))
+        QgsProject.instance().clear()
+    results.extend(load_relations_benchmarks(args.relations, args.repeat))
+    QgsProject.instance().clear()
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': metadata(), 'results': results}, f, indent=2)
+    print('\nResults written to {}'.format(args.output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()